@@ -4,26 +4,46 @@ import pandas as pd
 import h5py
 import awkward
 import numpy as np
+import functools
 
 from geeksw.utils import awkward_utils
+from geeksw.utils.core import nbytes
+from geeksw.utils.columnar import save_columnar, load_columnar
+from geeksw.utils.compression import make_compression, is_compressed, decompress, awkward_whitelist
 
 vetoed_typenames = ["UprootIOWrapper", "TTree"]
 
 
-def save(filename, item):
+def save(filename, item, compression=None, mmap=False):
 
     typename = type(item).__name__
 
     if typename in vetoed_typenames:
         return False
 
+    # contiguous .npy buffers in a directory, which are memory-mapped by load
+    if mmap and typename in ["ndarray", "JaggedArray"]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+        if save_columnar(filename, item, compression=compression):
+            return True
+
+    if os.path.isdir(filename):
+        _remove(filename)
+
     if typename == "DataFrame":
-        item.to_hdf(filename, key="data")
+        if compression is None:
+            item.to_hdf(filename, key="data")
+        else:
+            compression.to_hdf(item, filename, key="data")
         return True
 
     if typename in ["ndarray", "JaggedArray"]:
         with h5py.File(filename, "w") as hf:
-            ah5 = awkward.hdf5(hf)
+            if compression is None:
+                ah5 = awkward.hdf5(hf)
+            else:
+                ah5 = awkward.hdf5(hf, compression=compression.awkward_policy())
             if typename == "JaggedArray":
                 ah5["data"] = awkward_utils.ascontiguousarray(item)
             else:
@@ -31,6 +51,9 @@ def save(filename, item):
         return True
 
     try:
+        if compression is not None:
+            compression.dump(item, filename)
+            return True
         with open(filename, "wb") as f:
             pickle.dump(item, f)
         return True
@@ -42,29 +65,39 @@ def save(filename, item):
 
 def load(filename, typename):
 
+    if os.path.isdir(filename):
+        return load_columnar(filename, mmap=True)
+
     if typename == "DataFrame":
         return pd.read_hdf(filename, key="data")
 
     if typename in ["ndarray", "JaggedArray"]:
         with h5py.File(filename, "r") as hf:
-            ah5 = awkward.hdf5(hf)
+            ah5 = awkward.hdf5(hf, whitelist=awkward_whitelist)
             array = ah5["data"]
         return array
 
     try:
         with open(filename, "rb") as pf:
-            product = pickle.load(pf)
-            return product
+            data = pf.read()
+        if is_compressed(data):
+            data = decompress(data)
+        return pickle.loads(data)
     except:
         return None
 
     return None
 
 
-from lockfile import LockFile
-import json
 import os
+import json
+import time
 import pickle
+import shutil
+import socket
+import sqlite3
+import threading
+from collections import OrderedDict
 
 
 def pickle_save(filename, item):
@@ -79,8 +112,101 @@ def pickle_load(filename, typename):
     return out
 
 
+# Order in which the entries are evicted for each eviction policy, as SQL ORDER BY clause
+eviction_orders = {
+    # least recently used first
+    "lru": "last_access",
+    # least frequently used first
+    "lfu": "hits, last_access",
+    # cheapest to recompute per byte first, counting the time for each time it was needed
+    "cost": "(compute_time + 0.001) * (hits + 1) / MAX(size, 1), last_access",
+}
+
+# Columns of the index database, with their definitions
+_index_columns = [
+    ("key", "TEXT PRIMARY KEY"),
+    ("typename", "TEXT NOT NULL"),
+    ("size", "INTEGER NOT NULL DEFAULT 0"),
+    ("last_access", "REAL NOT NULL DEFAULT 0"),
+    ("hits", "INTEGER NOT NULL DEFAULT 0"),
+    ("compute_time", "REAL NOT NULL DEFAULT 0"),
+]
+
+
+def _disk_usage(filename):
+    if os.path.isdir(filename):
+        return sum([_disk_usage(os.path.join(filename, f)) for f in os.listdir(filename)])
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _remove(filename):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename, ignore_errors=True)
+    elif os.path.exists(filename):
+        os.remove(filename)
+
+
+# The save function which takes the options of the IndexedCache as keyword arguments
+_default_save = save
+
+
 class IndexedCache(object):
-    def __init__(self, path="~/.cache/geeksw", save=save, load=load):
+    """Cache of items stored in files under `path`, which are looked up by a key in an index.
+
+    The index is a SQLite database in write-ahead logging mode, such that several threads
+    and processes can look up items concurrently while another one is inserting. An
+    `index.json` from older versions is imported into the database the first time it is opened.
+
+    The `compression` is a codec name or `geeksw.utils.compression.Compression` settings,
+    which are passed to the default `save` function and can't be used with another one. With
+    `mmap=True`, which also needs the default `save` function, it stores numpy arrays and
+    JaggedArrays as .npy files, which are memory-mapped when they are loaded, so only the
+    accessed parts are read from disk. Compressed arrays are still read completely.
+
+    With `max_bytes`, the cache is limited to that size on disk. When an insertion makes the
+    cache bigger, entries are evicted in a background thread, in the order given by the
+    `eviction_policy`: "lru" (least recently used), "lfu" (least frequently used) or "cost",
+    which keeps the entries with the highest compute time per byte as given to `put`.
+
+    With `memory_bytes`, up to that many bytes of recently saved or loaded items are also kept
+    in memory, so they don't have to be read from disk again. All insertions and deletions go
+    to both the memory and the disk, and each access checks the index, such that items which
+    were evicted or deleted by other processes are not returned. The items kept in memory are
+    returned as they are, so they should not be modified.
+    """
+
+    def __init__(
+        self,
+        path="~/.cache/geeksw",
+        save=save,
+        load=load,
+        compression=None,
+        max_bytes=None,
+        eviction_policy="lru",
+        memory_bytes=0,
+        mmap=False,
+    ):
+
+        if eviction_policy not in eviction_orders:
+            raise ValueError(
+                'Unknown eviction policy "{0}", should be one of {1}.'.format(eviction_policy, list(eviction_orders))
+            )
+
+        save_kwargs = dict()
+        compression = make_compression(compression)
+        if compression is not None:
+            if save is not _default_save:
+                raise ValueError("The compression can only be used with the default save function.")
+            save_kwargs["compression"] = compression
+        if mmap:
+            if save is not _default_save:
+                raise ValueError("Memory-mapping can only be used with the default save function.")
+            save_kwargs["mmap"] = True
+        if save_kwargs:
+            save = functools.partial(save, **save_kwargs)
 
         self._save = save
         self._load = load
@@ -91,85 +217,331 @@ class IndexedCache(object):
             os.makedirs(path)
 
         self._path = path
-        self._lock_filename = os.path.join(path, ".indexed-cache-lock")
-        self._index_filename = os.path.join(path, "index.json")
-
-    def _get_typename(self, key):
-        type_name = None
-
-        lock = LockFile(self._lock_filename)
-        lock.acquire()
+        self._index_filename = os.path.join(path, "index.sqlite")
+        self._json_index_filename = os.path.join(path, "index.json")
+
+        # markers for the keys which are being computed in get_or_compute
+        self._progress_dir = os.path.join(path, ".in-progress")
+        if not os.path.exists(self._progress_dir):
+            os.makedirs(self._progress_dir, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+
+        # sqlite connections can't be shared between threads, nor survive a fork
+        self._local = threading.local()
+
+        self._eviction_lock = threading.Lock()
+        self._eviction_thread = None
+
+        # key -> (item, size) in the order of the last access
+        self.memory_bytes = memory_bytes
+        self._memory = OrderedDict()
+        self._memory_usage = 0
+        self._memory_lock = threading.Lock()
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # autocommit mode, the transactions are started explicitly
+            connection = sqlite3.connect(self._index_filename, timeout=60.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._create_index(connection)
+            local.connection = connection
+            local.pid = os.getpid()
+            self._migrate_json_index(connection)
+        return local.connection
+
+    def _create_index(self, connection):
+        columns = ", ".join([name + " " + definition for name, definition in _index_columns])
+        connection.execute("CREATE TABLE IF NOT EXISTS items (" + columns + ")")
+
+        # add the columns which are missing in indices written by older versions
+        existing = [row[1] for row in connection.execute("PRAGMA table_info(items)")]
+        for name, definition in _index_columns:
+            if name not in existing:
+                try:
+                    connection.execute("ALTER TABLE items ADD COLUMN " + name + " " + definition)
+                except sqlite3.OperationalError:
+                    # added by another process in the meantime
+                    pass
+
+    def _migrate_json_index(self, connection):
+        if not os.path.exists(self._json_index_filename):
+            return
 
+        connection.execute("BEGIN IMMEDIATE")
         try:
-            with open(self._index_filename, "r") as f:
-                index = json.load(f)
-                if key in index:
-                    type_name = index[key]
+            # another process might have migrated the index while we were waiting for the lock
+            if os.path.exists(self._json_index_filename):
+                with open(self._json_index_filename, "r") as f:
+                    index = json.load(f)
+                now = time.time()
+                rows = [(k, v, _disk_usage(os.path.join(self._path, k)), now) for k, v in index.items()]
+                connection.executemany(
+                    "INSERT OR IGNORE INTO items (key, typename, size, last_access) VALUES (?, ?, ?, ?)", rows
+                )
+                os.rename(self._json_index_filename, self._json_index_filename + ".migrated")
         except:
-            pass
-
-        lock.release()
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
 
-        return type_name
+    def _get_typename(self, key):
+        row = self._connection().execute("SELECT typename FROM items WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
 
     def __contains__(self, key):
         return not self._get_typename(key) is None
 
-    def __setitem__(self, key, item):
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self._connection().execute("SELECT key FROM items")]
+
+    def _remember(self, key, item):
+        size = nbytes(item)
+        with self._memory_lock:
+            self._forget_unlocked(key)
+            if size > self.memory_bytes:
+                return
+            self._memory[key] = (item, size)
+            self._memory_usage += size
+            while self._memory_usage > self.memory_bytes:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_usage -= evicted_size
+
+    def _recall(self, key):
+        with self._memory_lock:
+            if key not in self._memory:
+                return None
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+    def _forget_unlocked(self, key):
+        if key in self._memory:
+            self._memory_usage -= self._memory.pop(key)[1]
+
+    def _forget(self, key):
+        with self._memory_lock:
+            self._forget_unlocked(key)
+
+    def memory_usage(self):
+        """Size of the items kept in memory.
+        """
+        return self._memory_usage
+
+    def nbytes(self):
+        """Total size of the cached files.
+        """
+        return self._connection().execute("SELECT TOTAL(size) FROM items").fetchone()[0]
+
+    def put(self, key, item, compute_time=0.0):
+        """Insert an item, which took `compute_time` seconds to compute.
+
+        Returns whether the item could be saved.
+        """
+        filename = os.path.join(self._path, key)
 
         saved = False
 
         try:
-            saved = self._save(os.path.join(self._path, key), item)
+            saved = self._save(filename, item)
         except:
             saved = False
 
         if not saved:
-            return
+            return False
 
-        lock = LockFile(self._lock_filename)
-        lock.acquire()
+        # the file is complete at this point, so readers never find an index entry without it
+        self._connection().execute(
+            "INSERT OR REPLACE INTO items (key, typename, size, last_access, hits, compute_time) "
+            "VALUES (?, ?, ?, ?, 0, ?)",
+            (key, type(item).__name__, _disk_usage(filename), time.time(), compute_time),
+        )
 
-        try:
-            with open(self._index_filename, "r") as f:
-                index = json.load(f)
-        except:
-            index = dict()
+        if self.memory_bytes > 0:
+            self._remember(key, item)
+
+        if self.max_bytes is not None:
+            self._evict_in_background()
+
+        return True
 
-        index[key] = type(item).__name__
+    def __setitem__(self, key, item):
+        self.put(key, item)
+
+    def _touch(self, key):
+        # records the access and tells whether the item is still in the index
+        query = "UPDATE items SET last_access = ?, hits = hits + 1 WHERE key = ?"
+        return self._connection().execute(query, (time.time(), key)).rowcount
+
+    def _lookup(self, key):
+        # records the access and gets the type name with a single statement if sqlite is recent enough
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            type_name = self._get_typename(key)
+            self._touch(key)
+            return type_name
+        query = "UPDATE items SET last_access = ?, hits = hits + 1 WHERE key = ? RETURNING typename"
+        row = self._connection().execute(query, (time.time(), key)).fetchone()
+        return None if row is None else row[0]
+
+    def _get(self, key):
+        remembered = self._recall(key)
+        if remembered is not None:
+            if self._touch(key):
+                return True, remembered[0]
+            self._forget(key)
+
+        type_name = self._lookup(key)
 
-        with open(self._index_filename, "w") as f:
-            json.dump(index, f, indent=4)
+        if type_name is None:
+            return False, None
 
-        lock.release()
+        out = self._load(os.path.join(self._path, key), type_name)
+
+        if self.memory_bytes > 0:
+            self._remember(key, out)
+
+        return True, out
 
     def __getitem__(self, key):
-        type_name = self._get_typename(key)
+        found, out = self._get(key)
 
-        if type_name is None:
+        if not found:
             raise ValueError("Key " + key + " not found in cache")
 
-        out = self._load(os.path.join(self._path, key), type_name)
         return out
 
-    def __delitem__(self, key):
+    def _is_stale(self, marker, stale_timeout):
         try:
-            os.remove(os.path.join(self._path, key))
-        except:
+            with open(marker, "r") as f:
+                host, pid = f.read().split()
+            if host == socket.gethostname():
+                # the process which computes the item is gone
+                os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            # not written completely yet, or a process we can't signal
             pass
+        try:
+            return time.time() - os.path.getmtime(marker) > stale_timeout
+        except OSError:
+            return False
+
+    def _claim(self, key, stale_timeout):
+        marker = os.path.join(self._progress_dir, key)
+        try:
+            fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self._is_stale(marker, stale_timeout):
+                try:
+                    os.remove(marker)
+                except OSError:
+                    pass
+            return None
+        with os.fdopen(fd, "w") as f:
+            f.write(socket.gethostname() + " " + str(os.getpid()))
+        return marker
+
+    def get_or_compute(self, key, compute, poll_interval=0.1, stale_timeout=3600.0):
+        """Get an item, or compute and insert it if it's not in the cache.
+
+        Returns the item and whether it was found in the cache. While `compute` is running, a
+        marker file for the key tells other threads and processes calling `get_or_compute`
+        with the same key to wait for the result instead of computing it as well. Markers of
+        processes which died on the same host, or older than `stale_timeout` seconds, are ignored.
+        """
+        while True:
+            found, item = self._get(key)
+            if found:
+                return item, True
+            marker = self._claim(key, stale_timeout)
+            if marker is not None:
+                break
+            time.sleep(poll_interval)
 
-        lock = LockFile(self._lock_filename)
-        lock.acquire()
+        try:
+            # the item might have been inserted between the lookup and the claim
+            found, item = self._get(key)
+            if found:
+                return item, True
+
+            start_time = time.time()
+            item = compute()
+            self.put(key, item, compute_time=time.time() - start_time)
+        finally:
+            os.remove(marker)
+
+        return item, False
+
+    def __delitem__(self, key):
+        deleted = self._connection().execute("DELETE FROM items WHERE key = ?", (key,)).rowcount
+        self._forget(key)
 
         try:
-            with open(self._index_filename, "r") as f:
-                index = json.load(f)
+            _remove(os.path.join(self._path, key))
         except:
-            index = dict()
+            pass
 
-        del index[key]
+        if not deleted:
+            raise KeyError(key)
 
-        with open(self._index_filename, "w") as f:
-            json.dump(index, f, indent=4)
+    def evict(self, max_bytes=None):
+        """Remove entries until the cache is not bigger than `max_bytes`, by default the limit of the cache.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
 
-        lock.release()
+        connection = self._connection()
+        order = eviction_orders[self.eviction_policy]
+
+        excess = self.nbytes() - max_bytes
+        if excess <= 0:
+            return
+
+        candidates = connection.execute("SELECT key, size, last_access FROM items ORDER BY " + order).fetchall()
+
+        for key, size, last_access in candidates:
+            if excess <= 0:
+                break
+            # skip entries which were accessed or replaced since the selection
+            deleted = connection.execute(
+                "DELETE FROM items WHERE key = ? AND last_access = ?", (key, last_access)
+            ).rowcount
+            if deleted:
+                self._forget(key)
+                _remove(os.path.join(self._path, key))
+                excess -= size
+
+    def _run_eviction(self):
+        try:
+            self.evict()
+        finally:
+            self._eviction_lock.release()
+
+    def _evict_in_background(self):
+        # at most one eviction thread at a time, a later insertion triggers the next one if needed
+        if self.nbytes() <= self.max_bytes or not self._eviction_lock.acquire(blocking=False):
+            return
+        self._eviction_thread = threading.Thread(target=self._run_eviction, daemon=True)
+        self._eviction_thread.start()
+
+    def wait(self):
+        """Wait for a running eviction to finish.
+        """
+        thread = self._eviction_thread
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        """Wait for a running eviction and close the index database connection of the calling thread.
+        """
+        self.wait()
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.connection.close()
+        self._local = threading.local()
@@ -44,9 +44,25 @@ class Tracker(object):
         return self._method_decorator
 
 
-def make_f_hash_cache_tracker(cache_dir="~/.cache/geeksw", strict=True, verbosity=0):
-
-    cache = IndexedCache(path=cache_dir)
+def make_f_hash_cache_tracker(
+    cache_dir="~/.cache/geeksw",
+    strict=True,
+    verbosity=0,
+    compression=None,
+    max_bytes=None,
+    eviction_policy="lru",
+    memory_bytes=0,
+    mmap=False,
+):
+
+    cache = IndexedCache(
+        path=cache_dir,
+        compression=compression,
+        max_bytes=max_bytes,
+        eviction_policy=eviction_policy,
+        memory_bytes=memory_bytes,
+        mmap=mmap,
+    )
 
     def log(s):
         if verbosity >= 1:
@@ -124,8 +140,21 @@ def make_f_hash_cache_tracker(cache_dir="~/.cache/geeksw", strict=True, verbosit
                 output_source = args_source + kwargs_source + source
                 output_hash = md5(output_source.encode("utf-8")).hexdigest()
 
-                if output_hash in cache:
-                    elapsed_time, output = timer(lambda: cache[output_hash])
+                compute_times = []
+
+                def compute():
+                    if decorate_method:
+                        f = lambda: func(self, *args, **kwargs)
+                    else:
+                        f = lambda: func(*args, **kwargs)
+                    elapsed_time, output = timer(f)
+                    compute_times.append(elapsed_time)
+                    return output
+
+                # the calculation time is stored with the result for the "cost" eviction policy
+                elapsed_time, (output, hit) = timer(lambda: cache.get_or_compute(output_hash, compute))
+
+                if hit:
                     info = " "
                     if verbosity >= 1:
                         if type(output).__name__ == "ndarray":
@@ -137,19 +166,10 @@ def make_f_hash_cache_tracker(cache_dir="~/.cache/geeksw", strict=True, verbosit
                     log(func.__name__ + ": loading result from cache took {0:.2f} s".format(elapsed_time) + info)
                     return SourceHandle(output, output_source)
 
-                if decorate_method:
-                    f = lambda: func(self, *args, **kwargs)
-                else:
-                    f = lambda: func(*args, **kwargs)
-                elapsed_time, output = timer(f)
-
-                def c():
-                    cache[output_hash] = output
-
-                caching_time, _ = timer(c)
+                caching_time = elapsed_time - compute_times[0]
                 log(
                     func.__name__
-                    + ": calculating result took {0:.2f} s, caching {1:.2f} s".format(elapsed_time, caching_time)
+                    + ": calculating result took {0:.2f} s, caching {1:.2f} s".format(compute_times[0], caching_time)
                 )
 
                 return SourceHandle(output, output_source)
@@ -1,4 +1,9 @@
-from .stream import StreamList
+import os
+import inspect
+import functools
+from hashlib import md5
+from .stream import StreamList, LazyStreamList
+from .utils import load_module
 
 
 def expand_wildcard(product, datasets):
@@ -15,6 +20,24 @@ def replace_from_dict(s, subs):
     return s
 
 
+@functools.lru_cache(maxsize=None)
+def producer_source(func):
+    """Source code of a producer function, including its decorators.
+    """
+    # Producers found without importing their module know their source already
+    if hasattr(func, "source"):
+        return func.source
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return func.__name__
+
+
+@functools.lru_cache(maxsize=None)
+def _load_producer_module(source_file):
+    return load_module(os.path.basename(source_file)[:-3], source_file)
+
+
 class ExpandedProduct(dict):
     def __init__(self, products):
         sortedkeys = sorted(products.keys(), key=lambda x: x.lower())
@@ -31,10 +54,14 @@ class ProducerWrapper(object):
 
         self.datasets = datasets
         self.subs = subs
+        self.working_dir = working_dir
         self.product = working_dir + product
 
         self.requirements = {k: expand_wildcard(working_dir + v, datasets) for k, v in requirements.items()}
         self.flattened_requirements = [y for x in self.requirements.values() for y in x]
+        # The requirements which are merged over the datasets
+        self.wildcard_requirements = [k for k, v in requirements.items() if "*" in v]
+        self.is_increment = False
 
         self.cache = func.do_cache
         self.func = func
@@ -43,16 +70,22 @@ class ProducerWrapper(object):
             list(requirements.values()) + ["->", product] + ["(cache disabeled)" * int(not self.cache)]
         )
 
-    def run(self, record, n_stream_workers=1):
+        # Changes whenever the producer code or the specialization changes, but not the inputs
+        self.source_hash = md5((self.product + producer_source(func)).encode("utf-8")).hexdigest()
+
+    def run(self, record, n_stream_workers=1, stream_executor="threads"):
         inputs = {}
         for k, req in self.requirements.items():
-            if len(req) > 1:
+            if len(req) > 1 or (self.is_increment and k in self.wildcard_requirements):
                 inputs[k] = ExpandedProduct({self.datasets[i]: record[x] for i, x in enumerate(req)})
             else:
                 inputs[k] = record[req[0]]
 
         if self.func.is_template:
             for k in inputs:
+                if isinstance(inputs[k], LazyStreamList):
+                    inputs[k] = inputs[k].map(self._set_subs)
+                    continue
                 try:
                     inputs[k].subs = self.subs
                     if isinstance(inputs[k], StreamList):
@@ -61,7 +94,39 @@ class ProducerWrapper(object):
                 except:
                     pass
 
-        return self.func(n_stream_workers, **inputs)
+        return self.func(n_stream_workers, stream_executor=stream_executor, **inputs)
+
+    def increment(self, datasets):
+        """Copy of the producer which only merges the given datasets.
+
+        The inputs from the datasets are passed as ExpandedProduct even if there is only one.
+        """
+        producer = ProducerWrapper(self.func, self.subs, self.working_dir, datasets)
+        producer.is_increment = True
+        producer.description += " (only " + ", ".join(datasets) + ")"
+        return producer
+
+    def _set_subs(self, chunk):
+        try:
+            chunk.subs = self.subs
+        except:
+            pass
+        return chunk
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Producers loaded from a file with `load_producers` can't be pickled by reference
+        if getattr(self.func, "source_file", None) is not None:
+            state["func"] = (self.func.source_file, self.func.source_name)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["func"], tuple):
+            source_file, source_name = state["func"]
+            state["func"] = getattr(_load_producer_module(source_file), source_name)
+            state["func"].source_file = source_file
+            state["func"].source_name = source_name
+        self.__dict__.update(state)
 
     def __eq__(self, other):
         """ Check if producer has same template specialization.
@@ -1,6 +1,14 @@
 import glob
 import os
+import re
+import json
+import shutil
+import tempfile
+import threading
+import queue
+import time
 import pickle
+from concurrent.futures import ThreadPoolExecutor, Future
 import pandas as pd
 import h5py
 import awkward
@@ -10,23 +18,65 @@ import numpy as np
 import torch
 
 from .utils import mkdir
-from .stream import StreamList
+from .stream import StreamList, LazyStreamList
 from geeksw.utils import awkward_utils
+from geeksw.utils.columnar import save_columnar, load_columnar, load_columnar_meta, LazyColumns
+from geeksw.utils.compression import make_compression, is_compressed, decompress, awkward_whitelist
 
-vetoed_classnames = ["UprootIOWrapper", "TTree"]
+# Lazy streams are not cached, as this would mean producing them once more
+vetoed_classnames = ["UprootIOWrapper", "TTree", "LazyStreamList"]
 
 
-def _save_to_cache(filename, item):
+def _awkward_hdf5(hf, compression=None):
+    if compression is None:
+        return awkward.hdf5(hf, whitelist=awkward_whitelist)
+    return awkward.hdf5(hf, whitelist=awkward_whitelist, compression=compression.awkward_policy())
+
+
+def _chunk_length(item):
+    try:
+        return len(item)
+    except TypeError:
+        return None
+
+
+def _chunk_schema(item):
+    classname = type(item).__name__
+    if classname == "DataFrame":
+        return dict(type=classname, columns=[str(c) for c in item.columns], dtypes=[str(t) for t in item.dtypes])
+    if classname == "ndarray":
+        return dict(type=classname, dtype=str(item.dtype), shape=list(item.shape[1:]))
+    return dict(type=classname)
+
+
+def _disk_usage(filename):
+    if not os.path.isdir(filename):
+        return os.path.getsize(filename)
+    return sum([os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(filename) for f in files])
+
+
+def _save_to_cache(filename, item, format="hdf5", compression=None):
+    """Save an item to the cache and return the name of the file or directory it was written to.
+
+    A StreamList becomes a directory with one file per chunk and a manifest.json, which
+    lists the chunk files with their type, first entry, length and size on disk.
+    """
 
     classname = type(item).__name__
 
     if classname in vetoed_classnames:
-        return
+        return None
+
+    # Arrays and DataFrames as raw column buffers, other types are written like in the hdf5 format
+    if format == "columnar" and save_columnar(filename + ".cols", item, compression=compression):
+        return filename + ".cols"
 
     if classname == "StreamList":
         if type(item[0]).__name__ in vetoed_classnames:
-            return
+            return None
         mkdir(filename)
+        chunks = []
+        start = 0
         for i, subitem in enumerate(item):
             subclassname = type(subitem).__name__
             if subclassname == "StreamList":
@@ -34,21 +84,38 @@ def _save_to_cache(filename, item):
             subfilename = os.path.join(
                 filename, os.path.basename(filename.replace(classname, subclassname)) + "__{0:04d}".format(i)
             )
-            _save_to_cache(subfilename, subitem)
-        return
+            subfilename = _save_to_cache(subfilename, subitem, format=format, compression=compression)
+            length = _chunk_length(subitem)
+            chunks.append(
+                dict(
+                    file=os.path.relpath(subfilename, filename),
+                    type=subclassname,
+                    start=start,
+                    length=length,
+                    nbytes=_disk_usage(subfilename),
+                )
+            )
+            start = None if start is None or length is None else start + length
+        manifest = dict(version=1, schema=_chunk_schema(item[0]), chunks=chunks)
+        with open(os.path.join(filename, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        return filename
 
     if classname == "DataFrame":
-        item.to_hdf(filename + ".h5", key="data")
-        return
+        if compression is None:
+            item.to_hdf(filename + ".h5", key="data")
+        else:
+            compression.to_hdf(item, filename + ".h5", key="data")
+        return filename + ".h5"
 
     if classname in ["ndarray", "JaggedArray"]:
         with h5py.File(filename + ".h5", "w") as hf:
-            ah5 = awkward.hdf5(hf)
+            ah5 = _awkward_hdf5(hf, compression=compression)
             if classname == "JaggedArray":
                 ah5["data"] = awkward_utils.ascontiguousarray(item)
             else:
                 ah5["data"] = np.ascontiguousarray(item)
-        return
+        return filename + ".h5"
 
     # For TLorentsVectorArray from ptetaphimass
     if (
@@ -61,30 +128,37 @@ def _save_to_cache(filename, item):
         contents = item._content._content._contents
         filename = filename.replace("JaggedArrayMethods", "JaggedArrayMethods_PtEtaPhiMassLorentzVectorArray_Table")
         with h5py.File(filename + ".h5", "w") as hf:
-            ah5 = awkward.hdf5(hf)
+            ah5 = _awkward_hdf5(hf, compression=compression)
             for k, v in contents.items():
                 a = awkward.JaggedArray(starts, stops, v)
                 ah5[k] = awkward_utils.ascontiguousarray(a)
-        return
+        return filename + ".h5"
 
     # for pytorch nn models
     if issubclass(type(item), torch.nn.Module):
         torch.save(item, filename + ".pt")
-        return
+        return filename + ".pt"
+
+    if compression is not None:
+        compression.dump(item, filename + ".pkl")
+        return filename + ".pkl"
 
     with open(filename + ".pkl", "wb") as f:
         pickle.dump(item, f)
-    return
+    return filename + ".pkl"
 
 
-def _get_from_cache(filename):
+def _get_from_cache(filename, lazy=False):
 
     basename = os.path.basename(filename)
 
+    if filename.endswith(".cols"):
+        if lazy and load_columnar_meta(filename)["type"] in ["DataFrame", "Table"]:
+            return LazyColumns(filename)
+        return load_columnar(filename)
+
     if "__StreamList" in basename:
-        filenames = glob.glob(filename + "/*")
-        stream_list = StreamList([_get_from_cache(f) for f in sorted(filenames)])
-        return stream_list
+        return load_stream(filename)
 
     if "__DataFrame" in basename:
         return pd.read_hdf(filename, key="data")
@@ -93,7 +167,7 @@ def _get_from_cache(filename):
     if "JaggedArrayMethods_PtEtaPhiMassLorentzVectorArray_Table" in basename:
         content = OrderedDict()
         with h5py.File(filename, "r") as hf:
-            ah5 = awkward.hdf5(hf)
+            ah5 = _awkward_hdf5(hf)
             for k in ah5:
                 content[k] = ah5[k]
         particles = uproot_methods.TLorentzVectorArray.from_ptetaphim(
@@ -106,7 +180,7 @@ def _get_from_cache(filename):
 
     if "__ndarray" in basename or "__JaggedArray" in basename:
         with h5py.File(filename, "r") as hf:
-            ah5 = awkward.hdf5(hf)
+            ah5 = _awkward_hdf5(hf)
             array = ah5["data"]
         return array
 
@@ -118,51 +192,257 @@ def _get_from_cache(filename):
 
     if filename.endswith(".pkl"):
         with open(filename, "rb") as pf:
-            product = pickle.load(pf)
-        return product
+            data = pf.read()
+        # Compressed pickles are recognized by the header of the compressed frame
+        if is_compressed(data):
+            data = decompress(data)
+        return pickle.loads(data)
+
+
+def read_stream_manifest(filename):
+    """The manifest of a StreamList saved in the directory `filename`.
+    """
+    try:
+        with open(os.path.join(filename, "manifest.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+
+    # Cache entries written before there were manifests
+    filenames = glob.glob(filename + "/*")
+    # sort by the chunk index, which is the last part of the name
+    filenames = sorted(filenames, key=lambda f: int(os.path.basename(f).split("__")[-1].split(".")[0]))
+    chunks = [dict(file=os.path.basename(f), start=None, length=None, nbytes=_disk_usage(f)) for f in filenames]
+    return dict(version=0, schema=None, chunks=chunks)
+
+
+def load_stream(filename, start=0, stop=None, lazy=False, n_threads=None):
+    """Load the chunks `start` to `stop` of a StreamList saved in the directory `filename`.
+
+    The chunks are read in `n_threads` parallel threads. With `lazy=True`, a LazyStreamList
+    is returned instead, which reads the chunks one by one while iterating over it. To resume
+    a stream from a certain entry, the chunk can be found from the `start` entries of the
+    chunks in the manifest.
+    """
+    chunks = read_stream_manifest(filename)["chunks"][start:stop]
+    filenames = [os.path.join(filename, chunk["file"]) for chunk in chunks]
+
+    if lazy:
+        return LazyStreamList(lambda: (_get_from_cache(f) for f in filenames))
+
+    if len(filenames) <= 1:
+        return StreamList([_get_from_cache(f) for f in filenames])
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        return StreamList(list(pool.map(_get_from_cache, filenames)))
+
+
+def _remove_cache_file(filename):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    else:
+        os.remove(filename)
 
 
 class FrameworkCache(object):
-    def __init__(self, cache_dir):
+    """Cache for the products of the framework.
+
+    The keys are either product names, or tuples of the product name and a hash of the
+    product content. With a hash, only the entry with the same hash is found, and storing
+    a new version of a product removes the versions with other hashes.
+
+    With `format="columnar"`, numpy arrays, JaggedArrays and DataFrames are stored as raw
+    .npy buffers which are memory-mapped when loaded, so reading them is almost free until
+    the data is accessed. The default "hdf5" format uses hdf5 files for these types.
+    If in addition `lazy=True`, DataFrames and awkward Tables are loaded as LazyColumns
+    proxies, which only read the columns that are accessed.
+
+    The `compression` can be the name of a codec or `geeksw.utils.compression.Compression`
+    settings. The entries are then compressed in chunks in parallel threads, and the bytes of
+    floating point arrays are shuffled first. DataFrames in hdf5 files are compressed by
+    pytables instead, which does not support all codecs, see `Compression.to_hdf`. Compressed
+    entries are read without specifying the compression.
+    """
+
+    def __init__(self, cache_dir, format="hdf5", lazy=False, compression=None):
+
+        if format not in ["hdf5", "columnar"]:
+            raise ValueError('Unknown cache format "{0}", should be "hdf5" or "columnar".'.format(format))
 
         # Create the cache dir structure
         mkdir(cache_dir)
 
         self.cache_dir = cache_dir
+        self.format = format
+        self.lazy = lazy
+        self.compression = make_compression(compression)
+        # Small json files with information like the runtime of the producer for each entry
+        self._meta_dir = os.path.join(cache_dir, ".meta")
+
+    @staticmethod
+    def _split_key(key):
+        if isinstance(key, tuple):
+            return key
+        return key, None
+
+    def _prefix(self, key):
+        name, product_hash = self._split_key(key)
+        prefix = os.path.join(self.cache_dir, name.replace("/", "_")) + "__"
+        if product_hash is not None:
+            prefix += product_hash + "__"
+        return prefix
+
+    def _get_versions(self, key):
+        name, _ = self._split_key(key)
+        pattern = re.compile(re.escape(os.path.basename(self._prefix(name))) + "[0-9a-f]{32}__")
+        return [f for f in glob.glob(self._prefix(name) + "*") if pattern.match(os.path.basename(f))]
+
+    def versions(self, name):
+        """The hashes of all cached versions of a product.
+        """
+        n = len(os.path.basename(self._prefix(name)))
+        return [os.path.basename(f)[n : n + 32] for f in self._get_versions(name)]
 
     def __setitem__(self, key, item):
 
-        name = key
-        key = key.replace("/", "_")
+        name, product_hash = self._split_key(key)
+
+        basename = os.path.basename(self._prefix(key) + type(item).__name__)
 
-        filename = os.path.join(self.cache_dir, key + "__" + type(item).__name__)
+        # Write to a temporary directory first, such that no incomplete entries are ever found in the cache
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
 
         try:
-            _save_to_cache(filename, item)
+            _save_to_cache(os.path.join(tmp_dir, basename), item, format=self.format, compression=self.compression)
+
+            if product_hash is not None:
+                for f in self._get_versions(key):
+                    _remove_cache_file(f)
+                for f in glob.glob(self._meta_file(name) + "*"):
+                    os.remove(f)
+
+            for f in os.listdir(tmp_dir):
+                target = os.path.join(self.cache_dir, f)
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                os.replace(os.path.join(tmp_dir, f), target)
         except:
             print("Product " + name + " could not be cached.")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
     def __getitem__(self, key):
 
         filename = self._get_file(key)
 
-        key = key.replace("/", "_")
-
         if filename is None:
-            raise ValueError("Product " + key + " not found in cache!")
+            raise ValueError("Product " + self._split_key(key)[0] + " not found in cache!")
 
-        return _get_from_cache(filename)
+        return _get_from_cache(filename, lazy=self.lazy)
 
     def _get_file(self, key):
-        cache_file_wo_suffix = os.path.join(self.cache_dir, key.replace("/", "_")) + "__"
-        res = glob.glob(cache_file_wo_suffix + "*")
+        res = glob.glob(self._prefix(key) + "*")
         if res:
-            return res[0]
-        if len(res) > 0:
-            pass
+            # The most recent version if there is more than one
+            return max(res, key=os.path.getmtime)
         return None
 
     def __contains__(self, key):
         if self._get_file(key):
             return True
         return False
+
+    def _meta_file(self, key):
+        return os.path.join(self._meta_dir, os.path.basename(self._prefix(key)))
+
+    def get_metadata(self, key):
+        try:
+            with open(self._meta_file(key) + "meta.json", "r") as f:
+                return json.load(f)
+        except:
+            return dict()
+
+    def set_metadata(self, key, **metadata):
+        mkdir(self._meta_dir)
+        updated = self.get_metadata(key)
+        updated.update(metadata)
+        with open(self._meta_file(key) + "meta.json", "w") as f:
+            json.dump(updated, f)
+
+    def nbytes(self, key):
+        """Size of the cache entry on disk.
+        """
+        filename = self._get_file(key)
+        if filename is None:
+            return 0
+        return _disk_usage(filename)
+
+    def get_stream(self, key, start=0, stop=None, lazy=False):
+        """Load only the chunks `start` to `stop` of a cached StreamList, optionally lazily.
+        """
+        return load_stream(self._get_stream_file(key), start=start, stop=stop, lazy=lazy)
+
+    def stream_manifest(self, key):
+        """The manifest of a cached StreamList, with the file, length and size of each chunk.
+        """
+        return read_stream_manifest(self._get_stream_file(key))
+
+    def _get_stream_file(self, key):
+        filename = self._get_file(key)
+        if filename is None or "__StreamList" not in os.path.basename(filename):
+            raise ValueError("StreamList " + self._split_key(key)[0] + " not found in cache!")
+        return filename
+
+
+class CacheWriter(object):
+    """Writes products to a FrameworkCache in a background thread.
+
+    At most `maxsize` products wait to be written, after that `put` blocks until there is
+    space in the queue again. The products must not be modified before they are written,
+    which can be awaited with the Future returned by `put`.
+    """
+
+    def __init__(self, cache, maxsize=2):
+        self.cache = cache
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            key, item, metadata, callback, future = job
+            start_time = time.time()
+            try:
+                self.cache[key] = item
+                self.cache.set_metadata(key, **metadata)
+                if callback is not None:
+                    callback(time.time() - start_time)
+            except Exception as e:
+                print("Error when writing to the cache: " + str(e))
+            finally:
+                future.set_result(None)
+
+    def put(self, key, item, metadata={}, callback=None):
+        """Queue a product to be cached, optionally with metadata.
+
+        The callback is called with the time it took to save the product. Returns a Future
+        which is done when the product is written, or failed to be written.
+        """
+        future = Future()
+        self._queue.put((key, item, metadata, callback, future))
+        return future
+
+    def close(self):
+        """Wait until all products are written.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
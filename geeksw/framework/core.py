@@ -1,21 +1,45 @@
 import os
 import time
-import numpy as np
-import re
+import tempfile
 import awkward
 import h5py
+from hashlib import md5
+from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from .utils import *
 from .dependencies import *
+from .futures import SerialExecutor, WorkerPool, RunPool, executor_kind
+from .matching import ProducerIndex, compile_product_pattern, score_match
+from .planning import plan_producers, Plan
+from .discovery import scan_producers
+from .incremental import dataset_hashes, plan_increments
 from .ProducerWrapper import ProducerWrapper, expand_wildcard
-from .cache import FrameworkCache
+from .cache import FrameworkCache, CacheWriter
+from .record import Record
+from .profiling import Profile, Measurement, ProfileHistory
+from geeksw.utils.core import nbytes
+from geeksw.utils.columnar import LazyColumns
 
 
-def load_producers(producers_path):
+def load_producers(producers_path, lazy=True):
+    """Load the producers from all python files in a directory.
+
+    With `lazy=True`, the files are only parsed to find the producers, and a module is
+    imported when one of its producers is run for the first time. Files for which this
+    does not work, for example because of decorator arguments which are not literals or
+    because they import producers from other modules, are imported right away.
+    """
     producers = []
 
-    for file_name in os.listdir(producers_path):
+    for file_name in sorted(os.listdir(producers_path)):
         if file_name == "__init__.py" or file_name[-3:] != ".py":
             continue
+        if lazy:
+            lazy_producers = scan_producers(os.path.join(producers_path, file_name))
+            if lazy_producers is not None:
+                producers += lazy_producers
+                continue
         name = file_name[:-3]
         module = load_module(name, os.path.join(producers_path, file_name))
         for item in dir(module):
@@ -23,6 +47,9 @@ def load_producers(producers_path):
             if not hasattr(func, "product") or not hasattr(func, "requirements"):
                 continue
             file_path = os.path.join(producers_path, file_name)
+            # Such that the producer can be loaded again from the file in another process
+            func.source_file = os.path.abspath(file_path)
+            func.source_name = item
             producers.append(func)
     del file_name
 
@@ -34,48 +61,36 @@ def match_product(product, func, verbose=False):
     if verbose:
         print("Matching product " + product + "...")
 
-    regex = re.sub("<[^<>]*>", "[^/]*", func.product)
-    match = re.match(".*" + regex + "$", product)
-
-    if match is None:
-        return None, 0
-
-    depth = func.product.count("/")
-
-    # The matching pattern
-    group = "/".join(match.group().split("/")[-depth - 1 :])
-    # The "matching depth". Products which match deeper are resolving ambiguities.
-    score = group.count("/") + 1
-
-    # hotfix for problem in pattern matching:
-    # producer functions where the last identifier in the path is matched are usually to be favoured
-    if func.product.split("/")[-1] == product.split("/")[-1]:
-        score = score + 100
+    return score_match(product, func.product, compile_product_pattern(func.product))
 
-    # Penalize matching depth score with number of template specializations
-    # to give priority to full specializations.
-    score = score - len(group.split("/")) / 100.0
 
-    # if verbose:
-    # print(func.product, score)
+def get_required_producers(product, producer_funcs, datasets, record=None, cache=None, visited=None):
+    """Resolve the producers needed for a product, recursively through the requirements.
 
-    return group, score
+    If a `cache` is given, the search stops at products found in it, which are then loaded into the `record`.
+    """
 
+    if not isinstance(producer_funcs, ProducerIndex):
+        producer_funcs = ProducerIndex(producer_funcs)
 
-def get_required_producers(product, producer_funcs, datasets, record, cache):
+    # Products required by several producers only have to be resolved once
+    if visited is None:
+        visited = set()
+    if product in visited:
+        return []
+    visited.add(product)
 
-    if product in cache and not product in record:
+    if cache is not None and product in cache and not product in record:
         print("Loading  " + product + "from cache...")
         record[product] = cache[product]
         return []
 
-    groups, scores = zip(*[match_product(product, f) for f in producer_funcs])
+    resolved = producer_funcs.resolve(product)
 
-    if max(scores) == 0:
+    if resolved is None:
         return []
-    i = np.argmax(scores)
 
-    func, group = producer_funcs[i], groups[i]
+    func, group = resolved
 
     # The substitutions for the template specialization
     subs = {t: s for t, s in zip(func.product.split("/"), group.split("/")) if t != s}
@@ -83,67 +98,352 @@ def get_required_producers(product, producer_funcs, datasets, record, cache):
     working_dir = product[: -len(group)]
     producers = [ProducerWrapper(func, subs, working_dir, datasets)]
 
-    # print("Requirements for " + product + ":")
-
     for req in producers[0].flattened_requirements:
-        # print("    " + req)
-        producers += get_required_producers(req, producer_funcs, datasets, record, cache)
+        producers += get_required_producers(req, producer_funcs, datasets, record, cache, visited)
 
     return producers
 
 
-def produce(
-    products=None, producers=[], datasets=None, n_stream_workers=1, cache_time=2, verbosity=1, cache_dir=".geeksw_cache"
-):
-
-    target_products = products
+def resolve_producers(products, producers, datasets):
+    """Expand the wildcards in the requested products and resolve all the producers needed for them.
 
-    cache = FrameworkCache(cache_dir=cache_dir)
+    Returns the expanded target products and the producer instances.
+    """
+    target_products = [expand_wildcard(t[1:], datasets) for t in products]
+    target_products = [y for x in target_products for y in x]
 
-    if isinstance(producers, str):
-        producers = load_producers(producers)
+    index = ProducerIndex(producers)
+    visited = set()
 
     producer_instances = []
+    for t in target_products:
+        producer_instances += get_required_producers(t, index, datasets, visited=visited)
 
-    target_products = [expand_wildcard(t[1:], datasets) for t in target_products]
-    target_products = [y for x in target_products for y in x]
+    return target_products, list(set(producer_instances))
 
-    record = {}
 
-    for t in target_products:
-        producer_instances += get_required_producers(t, producers, datasets, record, cache)
+def compute_product_hashes(producers):
+    """Hash for each product to identify it in the cache.
 
-    producers = list(set(producer_instances))
+    The hash of a product combines the source hash of its producer with the hashes of the
+    requirements, so changing a producer invalidates everything downstream of it.
+    """
+    hashes = {}
 
-    exec_order = toposort(make_dependency_graph(producers))
+    for ip in toposort(make_dependency_graph(producers)):
+        p = producers[ip]
+        h = md5(p.source_hash.encode("utf-8"))
+        for req in p.flattened_requirements:
+            # requirements which are not produced are identified by their name
+            h.update(hashes.get(req, req).encode("utf-8"))
+        hashes[p.product] = h.hexdigest()
 
-    if verbosity > 0:
-        print("Producers:")
-        for i, ip in enumerate(exec_order):
-            print("{0}. ".format(i) + producers[ip].description)
+    return hashes
 
-    # Loop over producers needed to get to the desired output products
-    for i, ip in enumerate(exec_order):
 
-        start_time = time.time()
+def make_executor(executor, n_workers):
+    """Create the executor to run the producers with.
 
-        pname = producers[ip].product
-        if verbosity > 0:
-            print("Producing " + pname + "...")
+    With only one worker, the producers are run serially in the calling thread. An Executor
+    object, like a WorkerPool, is used as it is and not shut down at the end.
+    """
+    if isinstance(executor, Executor):
+        return nullcontext(executor)
+    if n_workers <= 1:
+        return SerialExecutor()
+    if executor == "threads":
+        return ThreadPoolExecutor(max_workers=n_workers)
+    if executor == "processes":
+        return ProcessPoolExecutor(max_workers=n_workers)
+    raise ValueError('Unknown executor "{0}", should be "threads" or "processes".'.format(executor))
+
+
+def _run_producer(producer, inputs, n_stream_workers, stream_executor, cpu_clock):
+    with Measurement(cpu_clock=cpu_clock) as measurement:
+        product = producer.run(inputs, n_stream_workers=n_stream_workers, stream_executor=stream_executor)
+    return product, measurement.stats
+
+
+def _profile_history(cache):
+    return ProfileHistory(os.path.join(cache.cache_dir, ".profile_history.json"))
+
+
+def plan(products, producers, datasets=None, cache_dir=".geeksw_cache", incremental=True):
+    """Plan the production of the products without running anything.
+
+    Returns a Plan with the producers that would run and the products that would be loaded
+    from the cache, which are chosen like in produce(). The Plan also has estimates of the
+    runtime and memory of each product, the critical path and the peak memory, based on the
+    previous runs of produce() with `profile=True`.
+    """
+    if isinstance(cache_dir, FrameworkCache):
+        cache = cache_dir
+    else:
+        cache = FrameworkCache(cache_dir=cache_dir)
+
+    if isinstance(producers, str):
+        producers = load_producers(producers)
+
+    target_products, producers = resolve_producers(products, producers, datasets)
+
+    hashes = compute_product_hashes(producers)
+    merged_hashes = {p.product: dataset_hashes(p, hashes) for p in producers if getattr(p.func, "additive", False)}
+    increments = {}
+    if incremental:
+        producers, increments = plan_increments(producers, hashes, cache)
+    producers, cached_products = plan_producers(producers, target_products, hashes, cache)
 
-        record[producers[ip].product] = producers[ip].run(record, n_stream_workers=n_stream_workers)
+    the_plan = Plan(target_products, producers, cached_products, hashes, cache, _profile_history(cache))
+    the_plan.increments = increments
+    the_plan.dataset_hashes = merged_hashes
+    return the_plan
 
-        requirements_all = []
-        for ipremain in exec_order[i + 1 :]:
-            requirements_all += producers[ipremain].flattened_requirements
 
-        if producers[ip].cache and time.time() - start_time > cache_time:
-            print("Pruducer time longer than {0:.2f} seconds, caching product...".format(cache_time))
-            pname = producers[ip].product
-            cache[pname] = record[pname]
+def produce(
+    products=None,
+    producers=[],
+    datasets=None,
+    n_stream_workers=1,
+    cache_time=2,
+    verbosity=1,
+    cache_dir=".geeksw_cache",
+    n_workers=1,
+    executor="threads",
+    stream_executor="threads",
+    memory_budget=None,
+    profile=False,
+    incremental=True,
+    cache_products=None,
+):
+    """Produce the requested products and everything they depend on.
+
+    Each producer is scheduled as soon as all its requirements are available, so with
+    `n_workers` > 1 independent branches of the dependency graph run concurrently.
+    The `executor` can be "threads" or "processes". With processes, the producer functions
+    and their inputs have to be picklable.
+
+    The chunks of streamed products are processed by `n_stream_workers` workers, again
+    either "threads" or "processes" as set with `stream_executor`. Threads are only useful
+    if the stream producers release the GIL. In the processes case, large numpy arrays and
+    JaggedArrays are returned to the main process via shared memory.
+
+    All stream producers in a run share the same workers, so the chunks of producers running
+    at the same time are processed together. Stream producers declared as `splittable` get
+    their biggest chunks split to keep all workers busy. Lazy streams can still be iterated
+    over after produce() returned, so they start their own workers for each iteration.
+
+    Both `executor` and `stream_executor` can also be a WorkerPool, which is kept alive
+    across produce() calls to avoid starting workers and importing modules again. The number
+    of workers is then taken from the pool. If the same pool is passed for both, the
+    producers run one after another and only the chunks use the pool.
+
+    Products which took longer than `cache_time` seconds get cached in the `cache_dir`, which
+    can also be a FrameworkCache to configure the cache format. The `cache_products` are cached
+    no matter how long they took, unless their producer disables caching. The products are
+    stored together with a hash of the source code of all producers they depend on, so after a
+    producer is modified only the products downstream of it are produced again. A cached product is not
+    loaded if producing it from cached requirements is expected to be faster, based on the
+    runtimes and loading times of previous runs. The products are written to the cache in a
+    background thread, and the producers consuming a product only start when it is written,
+    such that modifying their inputs in place does not change the cached product.
+
+    Products for single datasets are cached with hashes independent of the other datasets, so
+    when datasets are added only the producers for the new ones have to run. With
+    `incremental=True`, producers declared as `additive` also only merge the new datasets,
+    and combine the result with their cached result for the previous datasets.
+
+    With a lazy columnar cache, the columns of cached DataFrames which each producer uses are
+    recorded, such that only these get read up front in later runs.
+
+    If the products kept in memory for later producers exceed the `memory_budget` in bytes,
+    the biggest ones are written to a scratch directory in the cache and loaded again when
+    they are needed.
+
+    With `profile=True`, a Profile with timing, memory and caching information for each
+    producer is returned together with the record. The measurements are also kept in a
+    history next to the cache, from which `plan` estimates the resources for later runs.
+    """
+
+    the_plan = plan(products, producers, datasets=datasets, cache_dir=cache_dir, incremental=incremental)
+
+    cache_products = set() if cache_products is None else set(cache_products)
+
+    cache = the_plan.cache
+    target_products = the_plan.target_products
+    producers = the_plan.producers
+    cached_products = the_plan.cached_products
+    hashes = the_plan.hashes
+    increments = the_plan.increments
+    merged_hashes = the_plan.dataset_hashes
+
+    # every run spills into its own directory, such that runs sharing the cache don't interfere
+    spill_dir = None if memory_budget is None else tempfile.mkdtemp(prefix=".spill-", dir=cache.cache_dir)
+    record = Record(memory_budget=memory_budget, spill_dir=spill_dir)
+
+    run_profile = Profile()
+
+    for product in cached_products:
+        if verbosity > 0:
+            print("Loading " + product + " from cache...")
+        with Measurement() as measurement:
+            record[product] = cache[product, hashes[product]]
+            if isinstance(record[product], LazyColumns):
+                # read the columns which were used in previous runs right away
+                column_usage = cache.get_metadata((product, hashes[product])).get("column_usage", {})
+                record[product].prefetch(set([c for columns in column_usage.values() for c in columns]))
+        cache.set_metadata((product, hashes[product]), load_time=measurement.stats["wall_time"])
+        run_profile.add(
+            product=product,
+            kind="load",
+            requirements=[],
+            input_bytes=0,
+            output_bytes=nbytes(record[product]),
+            cache="hit",
+            cache_load_time=measurement.stats["wall_time"],
+            cache_save_time=0.0,
+            **measurement.stats
+        )
+
+    graph = make_dependency_graph(producers)
+    exec_order = toposort(graph)
 
-        for key in list(record.keys()):
-            if key not in requirements_all and key not in target_products:
-                del record[key]
+    if verbosity > 0:
+        print("Producers:")
+        for i, ip in enumerate(exec_order):
+            print("{0}. ".format(i) + producers[ip].description)
 
+    # How many producers still have to run before a requirement can be dropped from the record
+    n_consumers = defaultdict(int)
+    for p in producers:
+        for req in p.flattened_requirements:
+            n_consumers[req] += 1
+
+    in_degree = {ip: 0 for ip in graph}
+    for ip in graph:
+        for other in graph[ip]:
+            in_degree[other] += 1
+
+    ready = [ip for ip in exec_order if in_degree[ip] == 0]
+    running = {}
+    input_bytes = {}
+    # separate views on lazily loaded products to find out which columns each producer uses
+    column_views = defaultdict(dict)
+
+    if isinstance(stream_executor, Executor):
+        if n_stream_workers <= 1:
+            n_stream_workers = getattr(stream_executor, "n_workers", n_stream_workers)
+        if stream_executor is executor:
+            # producers waiting for their chunks in the same pool could block all workers
+            executor = "threads"
+            n_workers = 1
+        elif executor_kind(executor) == "processes":
+            # a pool can't be passed to producers in other processes
+            stream_executor = executor_kind(stream_executor)
+
+    if isinstance(executor, Executor):
+        n_workers = getattr(executor, "n_workers", n_workers)
+
+    # With threads, only the CPU time of the thread running the producer can be measured
+    cpu_clock = time.thread_time if executor_kind(executor) == "threads" and n_workers > 1 else time.process_time
+
+    # One pool for the chunks of all stream producers in this run, such that producers
+    # running at the same time share the workers and no pool is started for each producer
+    stream_context = nullcontext()
+    if isinstance(stream_executor, str) and n_stream_workers > 1 and executor_kind(executor) == "threads":
+        stream_executor = RunPool(stream_executor, n_stream_workers)
+        stream_context = stream_executor
+
+    # futures for the products which are being written to the cache
+    pending_writes = {}
+
+    with CacheWriter(cache) as cache_writer, make_executor(executor, n_workers) as pool, stream_context:
+
+        while ready or running:
+
+            # Submit all producers which have their requirements ready
+            while ready and len(running) < max(n_workers, 1):
+                ip = ready.pop(0)
+                if verbosity > 0:
+                    print("Producing " + producers[ip].product + "...")
+                # the producer might modify its inputs, which must not happen while they are written
+                for req in producers[ip].flattened_requirements:
+                    if req in pending_writes:
+                        pending_writes.pop(req).result()
+                # make sure the inputs are not spilled while collecting them
+                record.pinned.update(producers[ip].flattened_requirements)
+                inputs = {req: record[req] for req in producers[ip].flattened_requirements}
+                for req in inputs:
+                    if isinstance(inputs[req], LazyColumns):
+                        inputs[req] = column_views[ip][req] = inputs[req].view()
+                input_bytes[ip] = nbytes(list(inputs.values()))
+                future = pool.submit(_run_producer, producers[ip], inputs, n_stream_workers, stream_executor, cpu_clock)
+                running[future] = ip
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                ip = running.pop(future)
+                pname = producers[ip].product
+
+                running_requirements = [producers[other].flattened_requirements for other in running.values()]
+                record.pinned = set([req for reqs in running_requirements for req in reqs])
+
+                record[pname], stats = future.result()
+                elapsed_time = stats["wall_time"]
+                metadata = dict(runtime=elapsed_time)
+
+                if pname in increments:
+                    # combine with the result for the previous datasets
+                    previous_key = (pname, increments[pname])
+                    previous = cache[previous_key]
+                    if isinstance(previous, LazyColumns):
+                        previous = previous.materialize()
+                    record[pname] = producers[ip].func.reducer(previous, record[pname])
+                    metadata["runtime"] += cache.get_metadata(previous_key).get("runtime", 0.0)
+
+                if merged_hashes.get(pname) is not None:
+                    metadata["dataset_hashes"] = merged_hashes[pname]
+
+                for req, view in column_views.pop(ip, {}).items():
+                    column_usage = cache.get_metadata((req, hashes[req])).get("column_usage", {})
+                    column_usage[pname] = sorted(view.accessed_columns, key=str)
+                    cache.set_metadata((req, hashes[req]), column_usage=column_usage)
+
+                entry = run_profile.add(
+                    product=pname,
+                    kind="produce",
+                    requirements=producers[ip].flattened_requirements,
+                    input_bytes=input_bytes.pop(ip),
+                    output_bytes=nbytes(record[pname]),
+                    cache="miss" if producers[ip].cache else "disabled",
+                    cache_load_time=0.0,
+                    cache_save_time=0.0,
+                    **stats
+                )
+
+                if producers[ip].cache and (elapsed_time > cache_time or pname in cache_products):
+                    if elapsed_time > cache_time:
+                        print("Pruducer time longer than {0:.2f} seconds, caching product...".format(cache_time))
+                    pending_writes[pname] = cache_writer.put(
+                        (pname, hashes[pname]),
+                        record[pname],
+                        metadata=metadata,
+                        callback=lambda save_time, entry=entry: entry.update(cache_save_time=save_time),
+                    )
+
+                for req in producers[ip].flattened_requirements:
+                    n_consumers[req] -= 1
+                    if n_consumers[req] == 0 and req in record and req not in target_products:
+                        del record[req]
+
+                for other in graph[ip]:
+                    in_degree[other] -= 1
+                    if in_degree[other] == 0:
+                        ready.append(other)
+
+    record.close()
+
+    if profile:
+        _profile_history(cache).add(run_profile)
+        return record, run_profile
     return record
@@ -1,8 +1,242 @@
 import functools
-from concurrent.futures import ThreadPoolExecutor
-from .futures import MultiFuture
-from .ProducerWrapper import ExpandedProduct
-from .stream import StreamList
+import pandas as pd
+from collections import deque
+from .futures import RunPool, executor_kind, stream_pool
+from .ProducerWrapper import ExpandedProduct, _load_producer_module
+from .stream import StreamList, LazyStreamList, is_stream
+from .sharedmem import to_shared, from_shared, release_shared
+from .reduction import tree_reduce
+from ..utils.core import concatenate
+
+
+class _ProducerFromSource(object):
+    """Stand-in for a producer loaded with `load_producers`, which can be sent to worker processes.
+
+    The modules loaded from the producer files are not in `sys.modules`, so their functions
+    can't be pickled by reference. The worker loads the function from the file instead.
+    """
+
+    def __init__(self, source_file, source_name):
+        self.source_file = source_file
+        self.source_name = source_name
+
+    def __call__(self, *args, **kwargs):
+        return getattr(_load_producer_module(self.source_file), self.source_name)(*args, **kwargs)
+
+
+def _picklable(producer_func):
+    if getattr(producer_func, "source_file", None) is not None:
+        return _ProducerFromSource(producer_func.source_file, producer_func.source_name)
+    return producer_func
+
+
+def _run_stream_chunk(func, inputs):
+    return to_shared(func(**inputs))
+
+
+def _release_futures(futures):
+    """Release the shared memory of the outputs of futures which are not going to be received.
+
+    The futures which did not start yet are cancelled, the others have to be waited for.
+    """
+    for future in futures:
+        if future.cancel():
+            continue
+        try:
+            release_shared(future.result())
+        except Exception:
+            pass
+
+
+def _gather_shared(futures):
+    """Receive the outputs of futures, which might be in shared memory, in order.
+
+    If one of the futures failed, the shared memory of the other outputs is released before raising.
+    """
+    outputs = []
+    try:
+        for future in futures:
+            outputs.append(from_shared(future.result()))
+    except BaseException:
+        _release_futures(futures[len(outputs) :])
+        raise
+    return outputs
+
+
+def _iter_stream_inputs(inputs):
+    """Iterate over the inputs for each chunk, zipping all the stream inputs.
+    """
+    streams = {k: iter(v) for k, v in inputs.items() if is_stream(v)}
+    while True:
+        chunk_inputs = dict(inputs)
+        exhausted = []
+        for k, it in streams.items():
+            try:
+                chunk_inputs[k] = next(it)
+            except StopIteration:
+                exhausted.append(k)
+        if exhausted:
+            if len(exhausted) < len(streams):
+                raise ValueError("A stream produces can't take multiple stream inputs of different lengths!")
+            return
+        yield chunk_inputs
+
+
+def _iter_lazy_stream(producer_func, func, inputs, n_stream_workers, stream_executor):
+    if n_stream_workers <= 1:
+        for chunk_inputs in _iter_stream_inputs(inputs):
+            yield func(**chunk_inputs)
+        return
+
+    # Only have as many chunks in flight as there are workers to keep the memory bounded
+    with stream_pool(stream_executor, n_stream_workers) as executor:
+        if executor_kind(stream_executor) == "processes":
+            remote_func = _picklable(producer_func)
+            submit = lambda chunk_inputs: executor.submit(_run_stream_chunk, remote_func, chunk_inputs)
+        else:
+            submit = lambda chunk_inputs: executor.submit(func, **chunk_inputs)
+
+        pending = deque()
+        try:
+            for chunk_inputs in _iter_stream_inputs(inputs):
+                pending.append(submit(chunk_inputs))
+                if len(pending) >= n_stream_workers:
+                    yield from_shared(pending.popleft().result())
+            while pending:
+                yield from_shared(pending.popleft().result())
+        finally:
+            # after an error, or if the consumer stopped early
+            _release_futures(pending)
+
+
+def _fold_chunks(func, reducer, chunk_inputs):
+    return tree_reduce(reducer, (func(**inputs) for inputs in chunk_inputs))
+
+
+def _fold_chunks_shared(func, reducer, chunk_inputs):
+    return to_shared(_fold_chunks(func, reducer, chunk_inputs))
+
+
+def _map_reduce(producer_func, func, reducer, inputs, n_stream_workers, stream_executor):
+    """Run the function on each chunk and combine the outputs with the reducer.
+    """
+    if n_stream_workers <= 1 or any([isinstance(v, LazyStreamList) for v in inputs.values()]):
+        # fold the outputs as they come in
+        return tree_reduce(reducer, _iter_lazy_stream(producer_func, func, inputs, n_stream_workers, stream_executor))
+
+    # Each worker folds a contiguous group of chunks, then the partial results get combined
+    chunk_inputs = list(_iter_stream_inputs(inputs))
+    group_size = -(-len(chunk_inputs) // n_stream_workers)
+    groups = [chunk_inputs[i : i + group_size] for i in range(0, len(chunk_inputs), group_size)]
+
+    with stream_pool(stream_executor, n_stream_workers) as executor:
+        if executor_kind(stream_executor) == "processes":
+            remote_func = _picklable(producer_func)
+            futures = [executor.submit(_fold_chunks_shared, remote_func, reducer, group) for group in groups]
+            partials = _gather_shared(futures)
+        else:
+            futures = [executor.submit(_fold_chunks, func, reducer, group) for group in groups]
+            partials = [f.result() for f in futures]
+
+    return tree_reduce(reducer, partials)
+
+
+# Chunks are split such that each worker gets about this many pieces of a stream
+pieces_per_worker = 4
+
+# Only chunks with this many times the average number of entries get split
+split_factor = 2
+
+
+def _chunk_entries(chunk_inputs, stream_keys):
+    lengths = set()
+    for k in stream_keys:
+        try:
+            lengths.add(len(chunk_inputs[k]))
+        except TypeError:
+            return None
+    return lengths.pop() if len(lengths) == 1 else None
+
+
+def _split_chunk(chunk_inputs, stream_keys, n_entries, max_entries):
+    pieces = []
+    for start in range(0, n_entries, max_entries):
+        piece = dict(chunk_inputs)
+        for k in stream_keys:
+            piece[k] = chunk_inputs[k][start : start + max_entries]
+        pieces.append((piece, min(max_entries, n_entries - start)))
+    return pieces
+
+
+def _split_chunks(sinputs, stream_keys, n_workers):
+    """Split the chunks much bigger than the average into pieces of about the average size.
+
+    Returns a list of tasks with the chunk index, the inputs and the number of entries.
+    """
+    entries = [_chunk_entries(chunk_inputs, stream_keys) for chunk_inputs in sinputs]
+    known = [e for e in entries if e is not None]
+    if not known:
+        return [(i, chunk_inputs, 0) for i, chunk_inputs in enumerate(sinputs)]
+
+    mean_entries = -(-sum(known) // len(known))
+    # with many chunks, the pieces don't have to be as small as the average chunk
+    max_entries = max(mean_entries, -(-sum(known) // (n_workers * pieces_per_worker)), 1)
+
+    tasks = []
+    for i, chunk_inputs in enumerate(sinputs):
+        if entries[i] is None or entries[i] <= split_factor * mean_entries:
+            tasks.append((i, chunk_inputs, entries[i] or 0))
+            continue
+        try:
+            pieces = _split_chunk(chunk_inputs, stream_keys, entries[i], max_entries)
+        except Exception:
+            # inputs like TTrees can't be sliced
+            pieces = [(chunk_inputs, entries[i])]
+        tasks += [(i, piece, n_entries) for piece, n_entries in pieces]
+    return tasks
+
+
+def _join_pieces(pieces):
+    if len(pieces) == 1:
+        return pieces[0]
+    # unlike concatenate, keep the index of the entries in the chunk
+    if isinstance(pieces[0], (pd.DataFrame, pd.Series)):
+        return pd.concat(pieces)
+    return concatenate(pieces)
+
+
+def _run_chunks(producer_func, func, sinputs, stream_keys, n_workers, stream_executor, splittable):
+    """Run the function on the inputs for each chunk in parallel, the biggest chunks first.
+    """
+    if splittable:
+        tasks = _split_chunks(sinputs, stream_keys, n_workers)
+    else:
+        tasks = [
+            (i, chunk_inputs, _chunk_entries(chunk_inputs, stream_keys) or 0) for i, chunk_inputs in enumerate(sinputs)
+        ]
+
+    # Starting with the biggest tasks, such that no worker is left alone with a big one at the end
+    order = sorted(range(len(tasks)), key=lambda t: -tasks[t][2])
+
+    with stream_pool(stream_executor, n_workers) as executor:
+        futures = {}
+        if executor_kind(stream_executor) == "processes":
+            # The decorated function is submitted because only it can be pickled by reference.
+            # Called without StreamList inputs, it directly forwards to the wrapped function.
+            remote_func = _picklable(producer_func)
+            for t in order:
+                futures[t] = executor.submit(_run_stream_chunk, remote_func, tasks[t][1])
+            outputs = _gather_shared([futures[t] for t in range(len(tasks))])
+        else:
+            for t in order:
+                futures[t] = executor.submit(func, **tasks[t][1])
+            outputs = [futures[t].result() for t in range(len(tasks))]
+
+    # The pieces of a chunk are next to each other in the tasks
+    results = [[] for chunk_inputs in sinputs]
+    for task, output in zip(tasks, outputs):
+        results[task[0]].append(output)
+    return [_join_pieces(pieces) for pieces in results]
 
 
 def consumes(**requirements):
@@ -18,24 +252,48 @@ def consumes(**requirements):
     return wrapper
 
 
-def one_producer(product_names, stream=False, cache=True, merged=True):
+def one_producer(product_names, stream=False, cache=True, merged=True, lazy=False, reducer=None, additive=False):
+    """Decorator for producers that are run once.
+
+    With `stream=True` the function returns a list of chunks, which become a StreamList.
+    With `lazy=True` in addition, the chunks are only created when the stream is iterated over
+    by the consumers, so the function can also be a generator. Stream producers which consume
+    a lazy stream are lazy as well, such that each chunk goes through the whole chain of stream
+    producers before the next chunk gets loaded.
+
+    If an associative `reducer` is given (for example `reduction.add` for histograms or
+    `reduction.merge_cutflows`), streamed inputs are not concatenated. Instead, the function
+    is called for each chunk and the outputs are combined with the reducer as they come in.
+
+    A producer that merges datasets via wildcard requirements can declare itself `additive`,
+    meaning that its output for a set of datasets is the `reducer` applied to its outputs for
+    parts of the datasets. When new datasets are added, only they are then run through the
+    producer, and the result is combined with the cached result for the previous datasets.
+    """
     if isinstance(product_names, list) and len(product_names) > 1:
         raise ValueError("Producers functions with more than one product not supported yet!")
+    if additive and reducer is None:
+        raise ValueError("Additive producers need a reducer to combine the results for different datasets.")
     product_name = product_names
 
     def one_wrapper(func):
         @functools.wraps(func)
-        def producer_func(n_stream_workers=None, **inputs):
+        def producer_func(n_stream_workers=None, stream_executor="threads", **inputs):
+
+            if reducer is not None and any([is_stream(v) for v in inputs.values()]):
+                return _map_reduce(producer_func, func, reducer, inputs, n_stream_workers or 1, stream_executor)
 
             if merged:
                 for k1, product in inputs.items():
-                    if isinstance(product, StreamList):
+                    if is_stream(product):
                         inputs[k1] = product.aggregate()
                     if isinstance(product, ExpandedProduct):
                         for k2, subproduct in product.items():
-                            if isinstance(subproduct, StreamList):
+                            if is_stream(subproduct):
                                 inputs[k1][k2] = subproduct.aggregate()
 
+            if stream and lazy:
+                return LazyStreamList(lambda: func(**inputs))
             if stream:
                 return StreamList(func(**inputs))
             return func(**inputs)
@@ -44,6 +302,8 @@ def one_producer(product_names, stream=False, cache=True, merged=True):
         is_template = "<" in product_name or ">" in product_name
         producer_func.is_template = is_template
         producer_func.do_cache = cache
+        producer_func.reducer = reducer
+        producer_func.additive = additive
         if not hasattr(producer_func, "requirements"):
             producer_func.requirements = {}
         return producer_func
@@ -51,14 +311,32 @@ def one_producer(product_names, stream=False, cache=True, merged=True):
     return one_wrapper
 
 
-def stream_producer(product_names, cache=True):
+def stream_producer(product_names, cache=True, splittable=False):
+    """Decorator for producers which are run on each chunk of their streamed inputs.
+
+    The chunks are distributed over `n_stream_workers` workers, starting with the biggest
+    ones. With `splittable=True`, the function has to work on any range of entries of a
+    chunk, like a selection or a new column. Chunks much bigger than the average are then
+    split in ranges of about the average size which are processed in parallel, and the
+    outputs for the ranges are concatenated again, keeping the index of DataFrames. This
+    keeps all workers busy until the end of a stream with a few huge chunks. Chunks with
+    inputs that can't be sliced, like TTrees, are not split.
+    """
     if isinstance(product_names, list) and len(product_names) > 1:
         raise ValueError("Producers functions with more than one product not supported yet!")
     product_name = product_names
 
     def stream_wrapper(func):
         @functools.wraps(func)
-        def producer_func(n_stream_workers=1, **inputs):
+        def producer_func(n_stream_workers=1, stream_executor="threads", **inputs):
+            if any([isinstance(v, LazyStreamList) for v in inputs.values()]):
+                # The stream might be iterated after the workers of the run are shut down
+                if isinstance(stream_executor, RunPool):
+                    stream_executor = stream_executor.kind
+                return LazyStreamList(
+                    lambda: _iter_lazy_stream(producer_func, func, inputs, n_stream_workers, stream_executor)
+                )
+
             stream_list_lengths = set([len(v) for v in inputs.values() if isinstance(v, StreamList)])
 
             if len(stream_list_lengths) == 0:
@@ -77,8 +355,10 @@ def stream_producer(product_names, cache=True):
                     sinputs[i][k] = v[i] if isstream else v
 
             if n_stream_workers > 1:
-                with ThreadPoolExecutor(max_workers=n_stream_workers) as executor:
-                    results = MultiFuture([executor.submit(func, **sinputs[i]) for i in range(n)]).result()
+                stream_keys = [k for k, v in inputs.items() if isinstance(v, StreamList)]
+                results = _run_chunks(
+                    producer_func, func, sinputs, stream_keys, n_stream_workers, stream_executor, splittable
+                )
             else:
                 results = [func(**sinputs[i]) for i in range(n)]
             return StreamList(results)
@@ -47,3 +47,36 @@ def toposort(graph):
     else:  # if there is a cycle,
         print("Circular dependence! Will not do anything.")
         return []  # then return an empty list
+
+
+def critical_path(durations, requirements):
+    """Find the chain of dependent products which takes the longest time in total.
+
+    Args:
+        durations (dict): the time it takes to get each product
+        requirements (dict): the list of required products for each product
+
+    Returns:
+        The products along the critical path and its total duration.
+    """
+    finish = {}
+    previous = {}
+
+    def finish_time(product):
+        if product not in finish:
+            reqs = [req for req in requirements.get(product, []) if req in durations]
+            before = max(reqs, key=finish_time) if reqs else None
+            previous[product] = before
+            finish[product] = durations[product] + (finish_time(before) if before else 0.0)
+        return finish[product]
+
+    if not durations:
+        return [], 0.0
+
+    last = max(durations, key=finish_time)
+
+    path = [last]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+
+    return path[::-1], finish[last]
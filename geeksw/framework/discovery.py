@@ -0,0 +1,165 @@
+"""Discovery of the producers in a directory without importing the modules.
+
+The decorators of the functions are read from the syntax tree of each file. As long as
+all the decorator arguments are literals, the producers are represented by LazyProducer
+objects, which only import their module when they are called.
+"""
+
+import ast
+import inspect
+
+from .decorators import one_producer, stream_producer
+from .ProducerWrapper import _load_producer_module
+
+_producer_decorators = {"one_producer": one_producer, "stream_producer": stream_producer}
+_decorator_names = list(_producer_decorators) + ["consumes"]
+
+
+class LazyProducer(object):
+    """Stand-in for a decorated producer function, which imports its module on the first call.
+    """
+
+    def __init__(self, source_file, source_name, source, product, requirements, do_cache, reducer=None, additive=False):
+        self.source_file = source_file
+        self.source_name = source_name
+        self.__name__ = source_name
+        # The same source code as inspect.getsource would find, for the hashes of the products
+        self.source = source
+
+        self.product = product
+        self.requirements = requirements
+        self.is_template = "<" in product or ">" in product
+        self.do_cache = do_cache
+        self.reducer = reducer
+        self.additive = additive
+
+        self._func = None
+
+    def load(self):
+        """The actual producer function, importing the module if that did not happen yet.
+        """
+        if self._func is None:
+            self._func = getattr(_load_producer_module(self.source_file), self.source_name)
+            # Such that the function can be loaded again from the file in worker processes
+            self._func.source_file = self.source_file
+            self._func.source_name = self.source_name
+        return self._func
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_func"] = None
+        return state
+
+    def __repr__(self):
+        return "<LazyProducer " + self.source_name + " from " + self.source_file + ">"
+
+
+def _decorator_name(node):
+    if isinstance(node, ast.Call):
+        node = node.func
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def _literal_arguments(call):
+    args = [ast.literal_eval(arg) for arg in call.args]
+    kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+    if None in kwargs:
+        raise ValueError("Keyword arguments can't be unpacked statically.")
+    return args, kwargs
+
+
+def _scan_function(node, source_file, lines):
+    decorators = node.decorator_list
+    names = [_decorator_name(d) for d in decorators]
+
+    if not any([name in _producer_decorators for name in names]):
+        if "consumes" in names:
+            raise ValueError("Function " + node.name + " consumes something but does not produce anything.")
+        return None
+
+    # Only the usual form: the producer decorator on top, optionally followed by consumes
+    if names[0] not in _producer_decorators or names[1:] not in [[], ["consumes"]]:
+        raise ValueError("Unsupported decorators for producer " + node.name + ".")
+    if not all([isinstance(d, ast.Call) for d in decorators]):
+        raise ValueError("Producer decorators without arguments for " + node.name + ".")
+
+    args, kwargs = _literal_arguments(decorators[0])
+    arguments = inspect.signature(_producer_decorators[names[0]]).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    arguments = arguments.arguments
+
+    requirements = {}
+    if len(decorators) > 1:
+        consumes_args, requirements = _literal_arguments(decorators[1])
+        if consumes_args:
+            raise ValueError("The requirements of " + node.name + " are not given as keyword arguments.")
+
+    if arguments.get("reducer") is not None:
+        raise ValueError("The reducer of " + node.name + " can't be read statically.")
+
+    # the same block of lines which inspect.getsource finds, which can differ from the end of the
+    # function in the syntax tree, for example with a comment at the end of the function body
+    first_line = min([d.lineno for d in decorators])
+    source = "".join(inspect.getblock(lines[first_line - 1 :]))
+
+    return LazyProducer(
+        source_file,
+        node.name,
+        source,
+        arguments["product_names"],
+        requirements,
+        arguments["cache"],
+        additive=arguments.get("additive", False),
+    )
+
+
+def scan_producers(source_file):
+    """Find the producers in a python file without importing it.
+
+    Returns a list of LazyProducers, or None if the file can't be understood without importing
+    it. This is the case if any decorator argument is not a literal, if the decorators are
+    renamed or used in an unusual way, or if the file imports names with `from ... import`,
+    which could be producers defined in another module.
+    """
+    with open(source_file, "r") as f:
+        source = f.read()
+
+    try:
+        tree = ast.parse(source, filename=source_file)
+    except SyntaxError:
+        return None
+
+    lines = source.splitlines(True)
+    producers = []
+    decorator_calls = set()
+
+    try:
+        for node in tree.body:
+            # producers imported from other modules are only found by importing the file
+            if isinstance(node, ast.ImportFrom) and node.module != "__future__":
+                if any([alias.name not in _decorator_names for alias in node.names]):
+                    raise ValueError("Names imported from another module could be producers.")
+            if isinstance(node, ast.FunctionDef):
+                producer = _scan_function(node, source_file, lines)
+                if producer is not None:
+                    producers.append(producer)
+                    decorator_calls.update([id(d.func) for d in node.decorator_list])
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.alias) and node.name in _decorator_names and node.asname is not None:
+                raise ValueError("Renamed producer decorator.")
+            if isinstance(node, (ast.Name, ast.Attribute)) and _decorator_name(node) in _decorator_names:
+                if isinstance(node.ctx, ast.Load) and id(node) not in decorator_calls:
+                    raise ValueError("Producer decorator used outside of a decorator list.")
+
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+    return producers
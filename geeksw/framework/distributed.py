@@ -0,0 +1,355 @@
+"""Distribution of the per-dataset parts of produce() to worker processes, possibly on other hosts.
+
+The jobs are exchanged through a directory on a shared filesystem:
+
+    <job_id>.job      pickled function call, written by the submitting process
+    <job_id>.running  the same file, renamed by the worker which claimed the job, and touched
+                      by the worker regularly while the job runs
+    <job_id>.done     pickled result of the call
+    <job_id>.failed   traceback if the call raised an exception
+
+A worker is started on any host which sees the job directory with
+
+    python -m geeksw.framework.distributed <job_dir>
+
+A job whose `.running` file is not touched for a while is failed, because its worker died.
+
+The products are not sent back through the job directory, but through a FrameworkCache
+which has to be on the shared filesystem as well.
+"""
+
+import os
+import sys
+import time
+import uuid
+import pickle
+import shutil
+import tempfile
+import threading
+import traceback
+import subprocess
+from concurrent.futures import Executor, Future
+
+from .core import produce, resolve_producers, load_producers
+from .cache import FrameworkCache
+
+
+class JobError(Exception):
+    """Raised for a job which failed on a worker, with the traceback from the worker as message.
+    """
+
+    pass
+
+
+def _write_atomic(filename, data):
+    tmp_filename = filename + ".tmp-" + uuid.uuid4().hex
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+class _Heartbeat(object):
+    """Context manager which touches a file every `interval` seconds in a background thread.
+    """
+
+    def __init__(self, filename, interval):
+        self.filename = filename
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.filename)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(job_dir, poll_interval=0.1, idle_timeout=None, heartbeat_interval=10.0):
+    """Run the jobs which appear in `job_dir` until a file named "stop" is created in it.
+
+    With an `idle_timeout` in seconds, the worker also stops after not finding any job for
+    that long. While a job runs, its `.running` file is touched every `heartbeat_interval`
+    seconds, which has to be well below the `heartbeat_timeout` of the executor.
+    """
+    last_job_time = time.time()
+
+    while not os.path.exists(os.path.join(job_dir, "stop")):
+
+        job_files = sorted([f for f in os.listdir(job_dir) if f.endswith(".job")])
+
+        for job_file in job_files:
+            job_id = job_file[: -len(".job")]
+            running_file = os.path.join(job_dir, job_id + ".running")
+            try:
+                # Renaming is atomic, so only one worker gets the job
+                os.rename(os.path.join(job_dir, job_file), running_file)
+            except OSError:
+                continue
+
+            try:
+                with open(running_file, "rb") as f:
+                    fn, args, kwargs = pickle.load(f)
+                with _Heartbeat(running_file, heartbeat_interval):
+                    result = fn(*args, **kwargs)
+                output_file, output = job_id + ".done", pickle.dumps(result)
+            except Exception:
+                output_file, output = job_id + ".failed", traceback.format_exc().encode("utf-8")
+            except BaseException:
+                # the worker itself is stopped, so the job goes back to the queue for another worker
+                os.rename(running_file, os.path.join(job_dir, job_file))
+                raise
+
+            _write_atomic(os.path.join(job_dir, output_file), output)
+            os.remove(running_file)
+
+            last_job_time = time.time()
+            break
+
+        else:
+            if idle_timeout is not None and time.time() - last_job_time > idle_timeout:
+                return
+            time.sleep(poll_interval)
+
+
+class JobDirectoryExecutor(Executor):
+    """Executor which runs the function calls as jobs in a directory on a shared filesystem.
+
+    The functions and their arguments have to be picklable, and the functions importable by
+    the workers. The workers have to be started separately with `run_worker`.
+
+    A job fails with a JobError if the worker which claimed it does not touch its `.running`
+    file for `heartbeat_timeout` seconds. The time is measured with the clock of this process,
+    such that the clocks of the worker hosts don't matter.
+    """
+
+    def __init__(self, job_dir, poll_interval=0.1, heartbeat_timeout=60.0):
+
+        if not os.path.exists(job_dir):
+            os.makedirs(job_dir)
+
+        self.job_dir = job_dir
+        self.poll_interval = poll_interval
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self._futures = {}
+        # modification time of the `.running` file of each job, and when it was last seen changing
+        self._heartbeats = {}
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._poller = threading.Thread(target=self._poll, daemon=True)
+        self._poller.start()
+
+    def submit(self, fn, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError("Can't submit jobs after shutdown.")
+        job_id = "{0:.6f}-{1}".format(time.time(), uuid.uuid4().hex)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            self._futures[job_id] = future
+        _write_atomic(os.path.join(self.job_dir, job_id + ".job"), pickle.dumps((fn, args, kwargs)))
+        return future
+
+    def _poll(self):
+        while not self._shutdown or self._futures:
+            with self._lock:
+                pending = list(self._futures.items())
+            for job_id, future in pending:
+                try:
+                    finished = self._check_job(job_id, future)
+                except Exception as e:
+                    # for example an unpicklable result, which should not stop the polling for other jobs
+                    future.set_exception(e)
+                    finished = True
+                if finished:
+                    self._heartbeats.pop(job_id, None)
+                    with self._lock:
+                        del self._futures[job_id]
+            time.sleep(self.poll_interval)
+
+    def _check_job(self, job_id, future):
+        """Set the result of the future if the job is finished, and return whether it is.
+        """
+        done_file = os.path.join(self.job_dir, job_id + ".done")
+        failed_file = os.path.join(self.job_dir, job_id + ".failed")
+        if os.path.exists(done_file):
+            with open(done_file, "rb") as f:
+                data = f.read()
+            os.remove(done_file)
+            future.set_result(pickle.loads(data))
+            return True
+        if os.path.exists(failed_file):
+            with open(failed_file, "r") as f:
+                message = f.read()
+            os.remove(failed_file)
+            future.set_exception(JobError(message))
+            return True
+
+        try:
+            mtime = os.stat(os.path.join(self.job_dir, job_id + ".running")).st_mtime
+        except OSError:
+            # not claimed by a worker yet
+            return False
+        now = time.time()
+        if job_id not in self._heartbeats or self._heartbeats[job_id][0] != mtime:
+            self._heartbeats[job_id] = (mtime, now)
+        elif now - self._heartbeats[job_id][1] > self.heartbeat_timeout:
+            raise JobError("The worker running job " + job_id + " stopped sending heartbeats.")
+        return False
+
+    def shutdown(self, wait=True):
+        self._shutdown = True
+        if wait:
+            self._poller.join()
+
+
+class LocalJobExecutor(JobDirectoryExecutor):
+    """JobDirectoryExecutor with `n_workers` worker processes on the local machine.
+
+    This is a stand-in for workers on remote hosts. Without a `job_dir`, a temporary directory
+    is used and removed again at shutdown.
+    """
+
+    def __init__(self, n_workers=2, job_dir=None, poll_interval=0.1, heartbeat_timeout=60.0):
+
+        self._owns_job_dir = job_dir is None
+        if job_dir is None:
+            job_dir = tempfile.mkdtemp(prefix="geeksw-jobs-")
+
+        super(LocalJobExecutor, self).__init__(
+            job_dir, poll_interval=poll_interval, heartbeat_timeout=heartbeat_timeout
+        )
+
+        # The workers should find the same modules as this process
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([os.getcwd()] + sys.path)
+
+        self._workers = [
+            subprocess.Popen([sys.executable, "-m", "geeksw.framework.distributed", job_dir], env=env)
+            for i in range(n_workers)
+        ]
+
+    def shutdown(self, wait=True):
+        super(LocalJobExecutor, self).shutdown(wait=wait)
+        with open(os.path.join(self.job_dir, "stop"), "w"):
+            pass
+        for worker in self._workers:
+            worker.wait()
+        if self._owns_job_dir:
+            shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def partition_by_dataset(products, producers, datasets):
+    """Split the producers needed for the products into independent subgraphs for each dataset.
+
+    Returns for each dataset the producer instances for the products of that dataset, and
+    the products which are needed outside of the subgraph. Producers of products which belong
+    to no dataset, but are needed by the subgraph, are added to the subgraph of each dataset.
+    """
+    target_products, producer_instances = resolve_producers(products, producers, datasets)
+
+    def dataset_of(product):
+        for dataset in datasets:
+            if product == dataset or product.startswith(dataset + "/"):
+                return dataset
+        return None
+
+    partitions = {}
+    for p in producer_instances:
+        dataset = dataset_of(p.product)
+        if dataset is not None:
+            partitions.setdefault(dataset, ([], []))[0].append(p)
+
+    by_product = {p.product: p for p in producer_instances}
+
+    def add_shared_upstream(p, shared):
+        for req in p.flattened_requirements:
+            if req in by_product and dataset_of(req) is None and req not in shared:
+                shared[req] = by_product[req]
+                add_shared_upstream(by_product[req], shared)
+
+    for dataset, (partition, outputs) in partitions.items():
+        consumed_outside = set(
+            [req for p in producer_instances if dataset_of(p.product) != dataset for req in p.flattened_requirements]
+        )
+        for p in partition:
+            if p.product in target_products or p.product in consumed_outside:
+                outputs.append(p.product)
+
+        shared = {}
+        for p in partition:
+            add_shared_upstream(p, shared)
+        partition += list(shared.values())
+
+    return partitions
+
+
+def _produce_partition(partition, products, datasets, cache, kwargs):
+    producer_funcs = list(set([p.func for p in partition]))
+    # produce() strips the leading character of the requested products, which is usually a slash
+    requested = ["/" + product for product in products]
+    # Only the outputs are cached for sure, not all the intermediate products
+    produce(
+        products=requested,
+        producers=producer_funcs,
+        datasets=datasets,
+        cache_dir=cache,
+        cache_products=products,
+        **kwargs
+    )
+    return products
+
+
+def produce_distributed(products, producers, datasets, executor, cache_dir=".geeksw_cache", verbosity=1, **kwargs):
+    """Like produce(), but the subgraphs for the individual datasets are produced with `executor`.
+
+    The `executor` can be any concurrent.futures Executor, for example a JobDirectoryExecutor
+    whose workers run on other hosts. The products of the subgraphs are exchanged via the
+    cache, so the `cache_dir` must be reachable by all workers. Products which can't be
+    cached are produced again locally. What remains, like merging the datasets, is done
+    with produce() in this process.
+
+    The producers are sent to the workers with pickle. Producers loaded with `load_producers`
+    are loaded again from their files by the workers.
+    """
+    if isinstance(cache_dir, FrameworkCache):
+        cache = cache_dir
+    else:
+        cache = FrameworkCache(cache_dir=cache_dir)
+
+    if isinstance(producers, str):
+        producers = load_producers(producers)
+
+    partitions = partition_by_dataset(products, producers, datasets)
+
+    partition_kwargs = dict(kwargs, verbosity=0)
+
+    futures = []
+    for dataset, (partition, outputs) in partitions.items():
+        if not outputs:
+            continue
+        if verbosity > 0:
+            print("Submitting " + str(len(partition)) + " producers for " + dataset + "...")
+        futures.append(executor.submit(_produce_partition, partition, outputs, datasets, cache, partition_kwargs))
+
+    for future in futures:
+        future.result()
+
+    return produce(
+        products=products, producers=producers, datasets=datasets, cache_dir=cache, verbosity=verbosity, **kwargs
+    )
+
+
+if __name__ == "__main__":
+
+    run_worker(sys.argv[1])
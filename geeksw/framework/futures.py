@@ -1,3 +1,9 @@
+import os
+import threading
+from contextlib import nullcontext
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+
 class MultiFuture(object):
     def __init__(self, futures, merger=None):
 
@@ -24,3 +30,97 @@ class MultiFuture(object):
             return self.merger([f.result() for f in self.futures])
 
         return [f.result() for f in self.futures]
+
+
+class SerialExecutor(Executor):
+    """Executor which runs the submitted function immediately in the calling thread.
+
+    Makes the serial execution of the producers take the same code path as the parallel one.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class WorkerPool(Executor):
+    """Pool of worker threads or processes which can be reused for many produce() calls.
+
+    It can be passed as `executor` or `stream_executor` to produce(). Unlike the executors
+    produce() creates by itself, the pool is not shut down at the end of the call, so worker
+    processes keep their imported modules and opened files. The workers are started with the
+    first submitted task, and the `initializer` is run in each of them, for example to import
+    heavy modules up front.
+    """
+
+    def __init__(self, kind="threads", n_workers=None, initializer=None, initargs=()):
+
+        if kind not in ["threads", "processes"]:
+            raise ValueError('Unknown worker pool kind "{0}", should be "threads" or "processes".'.format(kind))
+
+        self.kind = kind
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self._initializer = initializer
+        self._initargs = initargs
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                pool_class = ThreadPoolExecutor if self.kind == "threads" else ProcessPoolExecutor
+                self._executor = pool_class(
+                    max_workers=self.n_workers, initializer=self._initializer, initargs=self._initargs
+                )
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self._get_executor().submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def __repr__(self):
+        return "WorkerPool({0}, n_workers={1})".format(self.kind, self.n_workers)
+
+
+class RunPool(WorkerPool):
+    """WorkerPool which produce() shares between the stream producers of one call.
+
+    It is shut down when the call returns, so lazy streams don't keep it but start their
+    own workers each time they are iterated over.
+    """
+
+    pass
+
+
+def executor_kind(executor):
+    """Whether an executor given by name or as object runs the tasks in "threads" or "processes".
+    """
+    if isinstance(executor, str):
+        return executor
+    if isinstance(executor, WorkerPool):
+        return executor.kind
+    if isinstance(executor, ProcessPoolExecutor):
+        return "processes"
+    return "threads"
+
+
+def stream_pool(stream_executor, n_workers):
+    """Executor for the chunks of a stream, to be used as context manager.
+
+    Only the executors which are created here for a name get shut down at the end.
+    """
+    if isinstance(stream_executor, Executor):
+        return nullcontext(stream_executor)
+    if stream_executor == "processes":
+        return ProcessPoolExecutor(max_workers=n_workers)
+    return ThreadPoolExecutor(max_workers=n_workers)
@@ -0,0 +1,66 @@
+from hashlib import md5
+
+
+def dataset_hashes(producer, hashes):
+    """Hash of the inputs from each dataset for a producer which merges datasets.
+
+    Returns None if the producer has no wildcard requirements.
+    """
+    if not producer.wildcard_requirements or not producer.datasets:
+        return None
+
+    # The requirements that are not merged are the same for all datasets
+    common = [
+        hashes.get(req, req)
+        for k in sorted(producer.requirements)
+        if k not in producer.wildcard_requirements
+        for req in producer.requirements[k]
+    ]
+
+    result = {}
+    for i, dataset in enumerate(producer.datasets):
+        h = md5(producer.source_hash.encode("utf-8"))
+        for x in common:
+            h.update(x.encode("utf-8"))
+        for k in sorted(producer.wildcard_requirements):
+            req = producer.requirements[k][i]
+            h.update(hashes.get(req, req).encode("utf-8"))
+        result[dataset] = h.hexdigest()
+
+    return result
+
+
+def plan_increments(producers, hashes, cache):
+    """Find the additive producers which only need to run on new datasets.
+
+    An additive producer qualifies if its product is not in the cache, but a previous version
+    was made from a subset of the current datasets with identical inputs. Such producers are
+    replaced by a copy which only merges the new datasets, so the producers upstream of the
+    previous datasets are not needed anymore.
+
+    Returns the producers and a dictionary with the hash of the previous version to combine
+    the result with for each incremental product.
+    """
+    increments = {}
+    planned = []
+
+    for p in producers:
+        current = dataset_hashes(p, hashes) if getattr(p.func, "additive", False) else None
+
+        if current is None or (p.product, hashes[p.product]) in cache:
+            planned.append(p)
+            continue
+
+        for old_hash in cache.versions(p.product):
+            previous = cache.get_metadata((p.product, old_hash)).get("dataset_hashes")
+            if not previous or any([current.get(ds) != h for ds, h in previous.items()]):
+                continue
+            new_datasets = [ds for ds in p.datasets if ds not in previous]
+            if new_datasets:
+                increments[p.product] = old_hash
+                p = p.increment(new_datasets)
+                break
+
+        planned.append(p)
+
+    return planned, increments
@@ -0,0 +1,98 @@
+import re
+import functools
+from collections import defaultdict
+
+
+@functools.lru_cache(maxsize=None)
+def compile_product_pattern(pattern):
+    """Regular expression to match product names with a producer pattern like `<dataset>/electrons`.
+    """
+    regex = re.sub("<[^<>]*>", "[^/]*", pattern)
+    return re.compile(".*" + regex + "$")
+
+
+def score_match(product, pattern, regex):
+
+    match = regex.match(product)
+
+    if match is None:
+        return None, 0
+
+    depth = pattern.count("/")
+
+    # The matching pattern
+    group = "/".join(match.group().split("/")[-depth - 1 :])
+    # The "matching depth". Products which match deeper are resolving ambiguities.
+    score = group.count("/") + 1
+
+    # hotfix for problem in pattern matching:
+    # producer functions where the last identifier in the path is matched are usually to be favoured
+    if pattern.split("/")[-1] == product.split("/")[-1]:
+        score = score + 100
+
+    # Penalize matching depth score with number of template specializations
+    # to give priority to full specializations.
+    score = score - len(group.split("/")) / 100.0
+
+    return group, score
+
+
+def is_template(s):
+    return "<" in s or ">" in s
+
+
+class ProducerIndex(object):
+    """Index of the producer functions by the last component of their product pattern.
+
+    Only the producers which can possibly match a product are scored, and the resolution
+    of each product name is memoized.
+    """
+
+    def __init__(self, producer_funcs):
+        self.producer_funcs = list(producer_funcs)
+
+        # Patterns with several components and no template in the last one
+        # can only match products with exactly the same last component.
+        self._by_last = defaultdict(list)
+        # Patterns with one component and no template match all products ending with it.
+        self._by_suffix = defaultdict(list)
+        # Patterns with a template in the last component have to be tried every time.
+        self._templated = []
+
+        for i, func in enumerate(self.producer_funcs):
+            components = func.product.split("/")
+            if is_template(components[-1]):
+                self._templated.append(i)
+            elif len(components) == 1:
+                self._by_suffix[components[0]].append(i)
+            else:
+                self._by_last[components[-1]].append(i)
+
+        self._resolved = {}
+
+    def candidates(self, product):
+        last = product.split("/")[-1]
+        positions = self._by_last.get(last, []) + self._templated
+        for i in range(len(last)):
+            positions = positions + self._by_suffix.get(last[i:], [])
+        return sorted(positions)
+
+    def resolve(self, product):
+        """Find the best matching producer function for a product.
+
+        Returns the producer function and the part of the product name matched by it,
+        or None if there is no matching producer.
+        """
+        if product in self._resolved:
+            return self._resolved[product]
+
+        best, best_score = None, 0
+
+        for i in self.candidates(product):
+            func = self.producer_funcs[i]
+            group, score = score_match(product, func.product, compile_product_pattern(func.product))
+            if score > best_score:
+                best, best_score = (func, group), score
+
+        self._resolved[product] = best
+        return best
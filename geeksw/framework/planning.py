@@ -0,0 +1,188 @@
+import math
+from collections import defaultdict
+
+from .dependencies import make_dependency_graph, toposort, critical_path
+
+# Assumed reading speed in bytes per second for cache entries which were never loaded before
+default_load_speed = 100e6
+
+
+def estimate_load_time(cache, key):
+    metadata = cache.get_metadata(key)
+    if "load_time" in metadata:
+        return metadata["load_time"]
+    return cache.nbytes(key) / default_load_speed
+
+
+def estimate_costs(producers, hashes, cache):
+    """Estimate for each product the time to load it from the cache and the time to produce it.
+
+    The time to produce a product includes the cheapest way to get its requirements. If a product
+    is not cached or the runtime of its producer is unknown, the corresponding time is infinite.
+    Requirements shared by several products are counted for each of them, so this is only a
+    heuristic for the total cost.
+    """
+    by_product = {p.product: p for p in producers}
+
+    costs = {}
+
+    def cost(product):
+        if product not in by_product:
+            return 0.0
+        if product not in costs:
+            key = (product, hashes[product])
+            load_time, runtime = math.inf, math.inf
+            if key in cache:
+                load_time = estimate_load_time(cache, key)
+                runtime = cache.get_metadata(key).get("runtime", math.inf)
+            requirements = set(by_product[product].flattened_requirements)
+            costs[product] = (load_time, runtime + sum([cost(req) for req in requirements]))
+        return min(costs[product])
+
+    for product in by_product:
+        cost(product)
+
+    return costs
+
+
+def plan_producers(producers, target_products, hashes, cache):
+    """Choose which products to load from the cache and which producers to run.
+
+    Going down from the target products, a cached product is loaded unless producing it again
+    from its requirements is expected to be faster.
+
+    Returns the producers to run and the cached products to load.
+    """
+    by_product = {p.product: p for p in producers}
+    costs = estimate_costs(producers, hashes, cache)
+
+    needed, cached = [], []
+
+    visited = set()
+    stack = list(target_products)
+
+    while stack:
+        product = stack.pop()
+        if product in visited or product not in by_product:
+            continue
+        visited.add(product)
+        load_time, produce_time = costs[product]
+        if load_time < math.inf and load_time <= produce_time:
+            cached.append(product)
+            continue
+        needed.append(by_product[product])
+        stack += by_product[product].flattened_requirements
+
+    return needed, cached
+
+
+class Plan(object):
+    """What produce() would do for a request, without running any producer.
+
+    The `producers` are the producer instances that would run, the `cached_products` are loaded
+    from the cache and `dag` maps each of these products to its requirements. The estimates of
+    the runtime and memory of each product come from the previous profiled runs in the
+    `history`, or from the cache metadata.
+    """
+
+    def __init__(self, target_products, producers, cached_products, hashes, cache, history):
+        self.target_products = target_products
+        self.producers = producers
+        self.cached_products = cached_products
+        self.hashes = hashes
+        self.cache = cache
+        self.history = history
+
+        # Additive producers which only merge new datasets, with the hash of the result to combine with
+        self.increments = {}
+        # Hashes of the inputs for each dataset of additive producers
+        self.dataset_hashes = {}
+
+        self.dag = {p.product: sorted(set(p.flattened_requirements)) for p in producers}
+        for product in cached_products:
+            self.dag[product] = []
+
+        self._estimates = None
+
+    @property
+    def estimates(self):
+        """For each product the estimated runtime in seconds (or loading time for cached
+        products), memory and output size in bytes. The values are None if unknown.
+        """
+        if self._estimates is None:
+            self._estimates = {}
+            for product in self.cached_products:
+                key = (product, self.hashes[product])
+                size = self.cache.nbytes(key)
+                self._estimates[product] = dict(
+                    runtime=estimate_load_time(self.cache, key), memory=size, output_bytes=size, source="cache"
+                )
+            for p in self.producers:
+                estimate = self.history.estimate(p.product)
+                if estimate is not None:
+                    estimate["source"] = "history"
+                else:
+                    runtime = self.cache.get_metadata((p.product, self.hashes[p.product])).get("runtime")
+                    estimate = dict(runtime=runtime, memory=None, output_bytes=None, source=None)
+                    if runtime is not None:
+                        estimate["source"] = "cache"
+                self._estimates[p.product] = estimate
+        return self._estimates
+
+    @property
+    def unknown(self):
+        """The products for which no runtime is known.
+        """
+        return sorted([product for product, e in self.estimates.items() if e["runtime"] is None])
+
+    def critical_path(self):
+        """The chain of products which is expected to take the longest, and its duration.
+
+        Products with unknown runtime are counted as taking no time.
+        """
+        durations = {product: e["runtime"] or 0.0 for product, e in self.estimates.items()}
+        return critical_path(durations, self.dag)
+
+    def total_runtime(self):
+        """Expected time to run everything with a single worker.
+        """
+        return sum([e["runtime"] or 0.0 for e in self.estimates.values()])
+
+    def peak_memory(self):
+        """Expected peak memory in bytes when running the producers one after another without memory budget.
+
+        The cached products are loaded first, and products are dropped once all their consumers ran.
+        """
+        size = {product: e["output_bytes"] or 0 for product, e in self.estimates.items()}
+
+        n_consumers = defaultdict(int)
+        for p in self.producers:
+            for req in set(p.flattened_requirements):
+                n_consumers[req] += 1
+
+        alive = sum([size[product] for product in self.cached_products])
+        peak = alive
+
+        for ip in toposort(make_dependency_graph(self.producers)):
+            p = self.producers[ip]
+            peak = max(peak, alive + (self.estimates[p.product]["memory"] or 0))
+            alive += size[p.product]
+            for req in set(p.flattened_requirements):
+                n_consumers[req] -= 1
+                if n_consumers[req] == 0 and req not in self.target_products:
+                    alive -= size.get(req, 0)
+            peak = max(peak, alive)
+
+        return peak
+
+    def __str__(self):
+        s = "Plan:"
+        for product in sorted(self.estimates):
+            e = self.estimates[product]
+            action = "load   " if product in self.cached_products else "produce"
+            runtime = "       ?  " if e["runtime"] is None else "{0:8.3f} s".format(e["runtime"])
+            s += "\n    {0} {1} {2}".format(action, runtime, product)
+        path, total = self.critical_path()
+        s += "\nCritical path ({0:.3f} s): {1}".format(total, " -> ".join(path))
+        s += "\nEstimated peak memory: {0:.1f} MB".format(self.peak_memory() / 1e6)
+        return s
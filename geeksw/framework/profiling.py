@@ -0,0 +1,161 @@
+import json
+import os
+import resource
+import threading
+import time
+
+from .dependencies import critical_path
+
+
+def max_rss():
+    """Peak resident memory of this process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Measurement(object):
+    """Measures the time and the memory while running a producer.
+    """
+
+    def __init__(self, cpu_clock=time.thread_time):
+        self._cpu_clock = cpu_clock
+
+    def __enter__(self):
+        self.start = time.time()
+        self._cpu_start = self._cpu_clock()
+        self._rss_start = max_rss()
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.time()
+        self.stats = dict(
+            start=self.start,
+            end=self.end,
+            wall_time=self.end - self.start,
+            cpu_time=self._cpu_clock() - self._cpu_start,
+            peak_memory_delta=max_rss() - self._rss_start,
+            pid=os.getpid(),
+            tid=threading.get_ident(),
+        )
+
+
+class Profile(object):
+    """Profiling information for each producer instance in a run of produce().
+
+    Every entry is a dictionary with the product name, the kind of the entry ("produce" or
+    "load"), the start and end time, the wall and CPU time, the increase of the peak memory,
+    the input and output sizes in bytes, whether there was a cache hit or miss and the time
+    it took to load or save the product from or to the cache.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, **entry):
+        self.entries.append(entry)
+        return entry
+
+    def get(self, product):
+        for entry in self.entries:
+            if entry["product"] == product:
+                return entry
+        return None
+
+    def critical_path(self):
+        """The chain of producers which took the longest time, and its duration.
+        """
+        durations = {e["product"]: e["wall_time"] for e in self.entries}
+        requirements = {e["product"]: e["requirements"] for e in self.entries}
+        return critical_path(durations, requirements)
+
+    def to_json(self, filename=None):
+        s = json.dumps(self.entries, indent=4)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(s)
+        return s
+
+    def to_chrome_trace(self, filename=None):
+        """Timeline in the Chrome trace event format, which can be opened in chrome://tracing.
+        """
+        if self.entries:
+            t0 = min([e["start"] for e in self.entries])
+        events = []
+        for e in self.entries:
+            args = {k: v for k, v in e.items() if k not in ["product", "start", "end", "pid", "tid"]}
+            events.append(
+                dict(
+                    name=e["product"],
+                    cat=e["kind"],
+                    ph="X",
+                    ts=(e["start"] - t0) * 1e6,
+                    dur=(e["end"] - e["start"]) * 1e6,
+                    pid=e["pid"],
+                    tid=e["tid"],
+                    args=args,
+                )
+            )
+        s = json.dumps(dict(traceEvents=events, displayTimeUnit="ms"))
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(s)
+        return s
+
+    def __str__(self):
+        s = "Profile:"
+        for e in sorted(self.entries, key=lambda e: -e["wall_time"]):
+            s += "\n    {0:8.3f} s wall, {1:8.3f} s cpu ({2}) {3}".format(
+                e["wall_time"], e["cpu_time"], e["kind"], e["product"]
+            )
+        return s
+
+
+class ProfileHistory(object):
+    """Measurements of the products in previous profiled runs, stored in a json file.
+
+    For each product name, the wall time, CPU time, peak memory increase and output size of
+    the last `max_runs` times it was produced are kept.
+    """
+
+    def __init__(self, filename, max_runs=10):
+        self.filename = filename
+        self.max_runs = max_runs
+        self._history = None
+
+    @property
+    def history(self):
+        if self._history is None:
+            try:
+                with open(self.filename, "r") as f:
+                    self._history = json.load(f)
+            except (IOError, ValueError):
+                self._history = dict()
+        return self._history
+
+    def add(self, profile):
+        """Add the produced products of a Profile and save the history.
+        """
+        for e in profile.entries:
+            if e["kind"] != "produce":
+                continue
+            runs = self.history.setdefault(e["product"], [])
+            runs.append({k: e[k] for k in ["wall_time", "cpu_time", "peak_memory_delta", "output_bytes"]})
+            del runs[: -self.max_runs]
+
+        # Replace the file at once, such that it is never read while incomplete
+        tmp_filename = self.filename + ".tmp-" + str(os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(self.history, f)
+        os.replace(tmp_filename, self.filename)
+
+    def estimate(self, product):
+        """Mean runtime and output size and largest memory usage of a product, None if it was never produced.
+        """
+        runs = self.history.get(product)
+        if not runs:
+            return None
+        return dict(
+            runtime=sum([r["wall_time"] for r in runs]) / len(runs),
+            memory=max([max(r["peak_memory_delta"], r["output_bytes"]) for r in runs]),
+            output_bytes=sum([r["output_bytes"] for r in runs]) / len(runs),
+        )
@@ -0,0 +1,104 @@
+import os
+import shutil
+
+from geeksw.utils.core import nbytes
+from .cache import FrameworkCache
+
+
+class _Spilled(object):
+    pass
+
+
+class Record(dict):
+    """Dictionary of the products which are in memory.
+
+    With a `memory_budget` in bytes, the largest products are written to the `spill_dir`
+    whenever the products in memory get bigger than the budget. The `spill_dir` is
+    removed when the record is closed, so it should not be shared. Spilled products are
+    loaded again when they are accessed. Products which are pinned are never spilled,
+    which is used to keep the inputs of running producers in memory.
+    """
+
+    def __init__(self, memory_budget=None, spill_dir=None):
+        super(Record, self).__init__()
+        self.memory_budget = memory_budget
+        self.pinned = set()
+        self._spill_dir = spill_dir
+        self._spill_cache = None
+        self._sizes = {}
+        self._unspillable = set()
+        self.n_spilled = 0
+
+    def memory_usage(self):
+        return sum(self._sizes.values())
+
+    def __setitem__(self, key, item):
+        super(Record, self).__setitem__(key, item)
+        self._sizes[key] = nbytes(item)
+        self._enforce_budget()
+
+    def __getitem__(self, key):
+        item = super(Record, self).__getitem__(key)
+        if isinstance(item, _Spilled):
+            item = self._spill_cache[key]
+            self._remove_spilled(key)
+            was_pinned = key in self.pinned
+            # don't spill the product again right away
+            self.pinned.add(key)
+            self[key] = item
+            if not was_pinned:
+                self.pinned.discard(key)
+        return item
+
+    def __delitem__(self, key):
+        if isinstance(super(Record, self).__getitem__(key), _Spilled):
+            self._remove_spilled(key)
+        super(Record, self).__delitem__(key)
+        self._sizes.pop(key, None)
+
+    def is_spilled(self, key):
+        return isinstance(super(Record, self).__getitem__(key), _Spilled)
+
+    def _remove_spilled(self, key):
+        filename = self._spill_cache._get_file(key)
+        if filename is None:
+            return
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
+
+    def _enforce_budget(self):
+        if self.memory_budget is None:
+            return
+
+        while self.memory_usage() > self.memory_budget:
+            candidates = [k for k in self._sizes if k not in self.pinned and k not in self._unspillable]
+            if not candidates:
+                return
+            self._spill(max(candidates, key=lambda k: self._sizes[k]))
+
+    def _spill(self, key):
+        if self._spill_cache is None:
+            # memory-mapped when loaded again, so only the parts which are used get read back
+            self._spill_cache = FrameworkCache(self._spill_dir, format="columnar")
+
+        self._spill_cache[key] = super(Record, self).__getitem__(key)
+
+        if not key in self._spill_cache:
+            # Some products like open files can't be spilled
+            self._unspillable.add(key)
+            return
+
+        super(Record, self).__setitem__(key, _Spilled())
+        del self._sizes[key]
+        self.n_spilled += 1
+
+    def close(self):
+        """Load all spilled products back into memory and clean up the spill directory.
+        """
+        for key in list(self.keys()):
+            self.pinned.add(key)
+            self[key]
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
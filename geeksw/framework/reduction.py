@@ -0,0 +1,34 @@
+import operator
+from geeksw.data_formats import Cutflow
+
+
+def tree_reduce(reducer, items):
+    """Combine the items pairwise in a balanced binary tree with an associative `reducer`.
+
+    The items can come from an iterator. They are merged as soon as possible, so only
+    about log2(n) partial results are kept in memory at any time. The order of the items
+    is preserved, hence the reducer does not need to be commutative.
+    """
+    stack = []
+    for item in items:
+        level = 0
+        while stack and stack[-1][0] == level:
+            item = reducer(stack.pop()[1], item)
+            level += 1
+        stack.append((level, item))
+
+    if not stack:
+        raise ValueError("Can't reduce an empty stream.")
+
+    result = stack.pop()[1]
+    while stack:
+        result = reducer(stack.pop()[1], result)
+    return result
+
+
+# Histograms as numpy arrays, running sums, counters...
+add = operator.add
+
+
+def merge_cutflows(a, b):
+    return Cutflow.average([a, b])
@@ -0,0 +1,87 @@
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import awkward
+
+# Below this size, pickling the array is cheaper than setting up a shared memory segment
+min_shared_bytes = 1024 * 1024
+
+
+class SharedArray(object):
+    """Handle to a copy of a numpy array in a shared memory segment.
+
+    Only the name, shape and dtype of the segment get pickled, such that the array
+    does not have to go through the pipe between the worker and the main process.
+    """
+
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        self.name = shm.name
+        # The segment stays alive until the receiving process unlinks it, so the resource
+        # tracker of this process must not remove it, or warn about it, when the process exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        shm.close()
+
+    def get(self):
+        """Copy the array out of the shared memory and release the segment.
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            array = np.array(np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf))
+        finally:
+            shm.close()
+            shm.unlink()
+        return array
+
+    def release(self):
+        """Release the segment without reading it.
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+class SharedJaggedArray(object):
+    def __init__(self, array):
+        self.starts = to_shared(array.starts)
+        self.stops = to_shared(array.stops)
+        self.content = to_shared(array.content)
+
+    def release(self):
+        for item in [self.starts, self.stops, self.content]:
+            release_shared(item)
+
+    def get(self):
+        return awkward.JaggedArray(from_shared(self.starts), from_shared(self.stops), from_shared(self.content))
+
+
+def to_shared(item):
+    """Move large numpy arrays and JaggedArrays into shared memory.
+
+    Everything else is returned as it is and will be pickled.
+    """
+    if type(item) == np.ndarray and not item.dtype.hasobject and item.nbytes >= min_shared_bytes:
+        return SharedArray(item)
+    if type(item) == awkward.JaggedArray and isinstance(item.content, np.ndarray):
+        return SharedJaggedArray(item)
+    return item
+
+
+def from_shared(item):
+    if isinstance(item, (SharedArray, SharedJaggedArray)):
+        return item.get()
+    return item
+
+
+def release_shared(item):
+    """Release the shared memory of an item which is not going to be received.
+    """
+    if isinstance(item, (SharedArray, SharedJaggedArray)):
+        item.release()
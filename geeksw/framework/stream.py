@@ -11,9 +11,6 @@ class StreamList(list):
         else:
             super(StreamList, self).__init__([product])
 
-        if len(self) > 10000:
-            raise ValueError("StreamList can't be longer than 10000 because the filenames for caching are not adequate")
-
         self._cached_aggregate = None
 
     def aggregate(self):
@@ -21,3 +18,30 @@ class StreamList(list):
             return concatenate(self)
         else:
             return self._cached_aggregate
+
+
+class LazyStreamList(object):
+    """Streamed product where the chunks are only produced while iterating over it.
+
+    The `source` is a function which returns a new iterator over the chunks. Nothing is kept
+    in memory between two iterations, so consuming the stream twice produces it twice.
+    """
+
+    def __init__(self, source):
+        self._source = source
+
+    def __iter__(self):
+        return iter(self._source())
+
+    def map(self, func):
+        return LazyStreamList(lambda: (func(chunk) for chunk in self))
+
+    def aggregate(self):
+        return concatenate(list(self))
+
+    def materialize(self):
+        return StreamList(list(self))
+
+
+def is_stream(product):
+    return isinstance(product, (StreamList, LazyStreamList))
@@ -0,0 +1,246 @@
+"""Storage of arrays and DataFrames as raw .npy buffers, which can be memory-mapped when loaded."""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import awkward
+
+from geeksw.utils import awkward_utils
+from geeksw.utils.compression import decompress
+
+
+def _save_array(filename, array, compression=None):
+    if compression is None or array.dtype.hasobject:
+        np.save(filename, np.ascontiguousarray(array), allow_pickle=array.dtype.hasobject)
+        return
+    # The npy header followed by the compressed buffer
+    array = np.ascontiguousarray(array)
+    with open(filename + ".z", "wb") as f:
+        np.lib.format.write_array_header_2_0(f, np.lib.format.header_data_from_array_1_0(array))
+        f.write(compression.compress_array(array))
+
+
+def _load_compressed_array(filename):
+    with open(filename, "rb") as f:
+        np.lib.format.read_magic(f)
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data = decompress(f.read())
+    return np.frombuffer(data, dtype=dtype).reshape(shape, order="F" if fortran_order else "C")
+
+
+def _load_array(filename, mmap=True):
+    if not os.path.exists(filename) and os.path.exists(filename + ".z"):
+        return _load_compressed_array(filename + ".z")
+    # Arrays of python objects can't be memory-mapped
+    try:
+        return np.load(filename, mmap_mode="c" if mmap else None)
+    except ValueError:
+        return np.load(filename, allow_pickle=True)
+
+
+def _is_raw_buffer(values):
+    # extension types like categoricals or timezone-aware datetimes would lose their dtype
+    return isinstance(values.dtype, np.dtype)
+
+
+def save_columnar(path, item, compression=None):
+    """Save a numpy array, a JaggedArray or a DataFrame into the directory `path`.
+
+    Each array or column goes into a separate .npy file. Returns False if the item can't be
+    stored like this, for example a DataFrame with categorical columns or a MultiIndex.
+    Compressed arrays, with `compression` settings from `geeksw.utils.compression`, are
+    decompressed into memory instead of being memory-mapped.
+    """
+    typename = type(item).__name__
+
+    if typename == "ndarray":
+        meta = dict(type=typename)
+        arrays = dict(data=item)
+
+    elif typename == "JaggedArray" and isinstance(item.content, np.ndarray):
+        item = awkward_utils.ascontiguousarray(item)
+        meta = dict(type=typename)
+        arrays = dict(starts=item.starts, stops=item.stops, content=item.content)
+
+    elif typename == "DataFrame" and not item.columns.has_duplicates:
+        columns = list(item.columns)
+        if not all([_is_raw_buffer(item[c]) for c in columns]):
+            return False
+        if isinstance(item.index, pd.MultiIndex) or not _is_raw_buffer(item.index):
+            return False
+        meta = dict(type=typename, columns=columns, dtypes=[str(item[c].dtype) for c in columns])
+        meta["index_name"] = item.index.name
+        arrays = {str(i): item[c].values for i, c in enumerate(columns)}
+        if isinstance(item.index, pd.RangeIndex):
+            meta["range_index"] = [item.index.start, item.index.stop, item.index.step]
+        else:
+            arrays["index"] = item.index.values
+
+    elif typename == "Table" and all([isinstance(item[c], np.ndarray) for c in item.columns]):
+        columns = list(item.columns)
+        meta = dict(type=typename, columns=columns, dtypes=[str(item[c].dtype) for c in columns])
+        arrays = {str(i): item[c] for i, c in enumerate(columns)}
+        meta["range_index"] = [0, len(item), 1]
+
+    else:
+        return False
+
+    try:
+        meta_json = json.dumps(meta)
+    except TypeError:
+        # column names that can't be stored
+        return False
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for name, array in arrays.items():
+        _save_array(os.path.join(path, name + ".npy"), np.asarray(array), compression=compression)
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        f.write(meta_json)
+
+    return True
+
+
+def load_columnar_meta(path):
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        return json.load(f)
+
+
+def load_column(path, meta, column, mmap=True):
+    """Load a single column of a DataFrame stored with `save_columnar`.
+    """
+    i = meta["columns"].index(column)
+    return _load_array(os.path.join(path, str(i) + ".npy"), mmap=mmap)
+
+
+def load_index(path, meta, mmap=True):
+    if "range_index" in meta:
+        return pd.RangeIndex(*meta["range_index"], name=meta.get("index_name"))
+    return pd.Index(_load_array(os.path.join(path, "index.npy"), mmap=mmap), name=meta.get("index_name"))
+
+
+def load_columnar(path, mmap=True):
+    """Load an item saved with `save_columnar`.
+
+    With `mmap=True`, the arrays are memory-mapped copy-on-write, so the data is only read from
+    disk when it's accessed. A DataFrame still copies the columns when it's constructed.
+    """
+    meta = load_columnar_meta(path)
+
+    if meta["type"] == "ndarray":
+        return _load_array(os.path.join(path, "data.npy"), mmap=mmap)
+
+    if meta["type"] == "JaggedArray":
+        arrays = [_load_array(os.path.join(path, k + ".npy"), mmap=mmap) for k in ["starts", "stops", "content"]]
+        return awkward.JaggedArray(*arrays)
+
+    if meta["type"] == "DataFrame":
+        data = {c: load_column(path, meta, c, mmap=mmap) for c in meta["columns"]}
+        return pd.DataFrame(data, index=load_index(path, meta, mmap=mmap), columns=meta["columns"])
+
+    if meta["type"] == "Table":
+        table = awkward.Table()
+        for c in meta["columns"]:
+            table[c] = load_column(path, meta, c, mmap=mmap)
+        return table
+
+    raise ValueError("Unknown columnar type " + meta["type"])
+
+
+class LazyColumns(object):
+    """Proxy for a DataFrame or an awkward Table stored with `save_columnar`.
+
+    Columns are only loaded when they are accessed, and the names of the accessed columns
+    are recorded in `accessed_columns`. Accessing anything that is not a column, like
+    DataFrame methods, loads the full product.
+    """
+
+    def __init__(self, path, meta=None, loaded=None):
+        self._path = path
+        self._meta = load_columnar_meta(path) if meta is None else meta
+        # The loaded columns, which are shared between the views on the same product
+        self._loaded = dict() if loaded is None else loaded
+        self._materialized = None
+        self.accessed_columns = set()
+
+    def view(self):
+        """New proxy for the same product, which records the accessed columns separately.
+        """
+        return LazyColumns(self._path, meta=self._meta, loaded=self._loaded)
+
+    @property
+    def columns(self):
+        if self._meta["type"] == "DataFrame":
+            return pd.Index(self._meta["columns"])
+        return list(self._meta["columns"])
+
+    @property
+    def index(self):
+        return load_index(self._path, self._meta)
+
+    @property
+    def nbytes(self):
+        """Memory used by the columns loaded so far.
+        """
+        return sum([self._loaded[c].nbytes for c in self._loaded])
+
+    def __len__(self):
+        if "range_index" in self._meta:
+            return len(range(*self._meta["range_index"]))
+        return len(self.index)
+
+    def _column(self, column):
+        self.accessed_columns.add(column)
+        if column not in self._loaded:
+            self._loaded[column] = load_column(self._path, self._meta, column)
+        array = self._loaded[column]
+        if self._meta["type"] == "DataFrame":
+            return pd.Series(array, index=self.index, name=column)
+        return array
+
+    def prefetch(self, columns):
+        """Read the given columns into memory.
+        """
+        for column in columns:
+            if column in self._meta["columns"] and column not in self._loaded:
+                self._loaded[column] = np.array(load_column(self._path, self._meta, column))
+
+    def materialize(self):
+        """Load the full product.
+        """
+        if self._materialized is None:
+            if self._meta["type"] == "DataFrame":
+                data = {c: self._column(c) for c in self._meta["columns"]}
+                self._materialized = pd.DataFrame(data, index=self.index, columns=self._meta["columns"])
+            else:
+                self._materialized = awkward.Table()
+                for c in self._meta["columns"]:
+                    self._materialized[c] = self._column(c)
+        self.accessed_columns.update(self._meta["columns"])
+        return self._materialized
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and key in self._meta["columns"]:
+            return self._column(key)
+        if isinstance(key, list) and all([isinstance(k, str) and k in self._meta["columns"] for k in key]):
+            if self._meta["type"] == "DataFrame":
+                return pd.DataFrame({k: self._column(k) for k in key}, index=self.index, columns=key)
+            table = awkward.Table()
+            for k in key:
+                table[k] = self._column(k)
+            return table
+        return self.materialize()[key]
+
+    def __getattr__(self, name):
+        # Attributes of the proxy itself are not found during unpickling
+        if name.startswith("_") or "_meta" not in self.__dict__:
+            raise AttributeError(name)
+        if name in self._meta["columns"]:
+            return self._column(name)
+        return getattr(self.materialize(), name)
+
+    def __repr__(self):
+        return "<LazyColumns " + self._meta["type"] + " with columns " + str(self._meta["columns"]) + ">"
@@ -0,0 +1,236 @@
+"""Compression of cache files in chunks, which are compressed and decompressed in parallel threads.
+
+The compressed data is written in a small self-describing frame, such that it can be
+decompressed without knowing the settings it was compressed with. The "zlib" and "lzma"
+codecs are always available, "lz4", "zstd" and "blosc" need the lz4, zstandard and blosc2
+packages respectively.
+"""
+
+import os
+import zlib
+import lzma
+import struct
+import pickle
+import numpy as np
+import awkward.persist
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _lz4_compress(data, level):
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def _lz4_decompress(data):
+    return lz4.frame.decompress(data)
+
+
+def _blosc_compress(data, level):
+    return blosc2.compress(data, typesize=1, clevel=level, filter=blosc2.Filter.NOFILTER)
+
+
+# Codec name -> (compress function, decompress function, default level, module it needs)
+codecs = {
+    "zlib": (zlib.compress, zlib.decompress, 1, zlib),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 1, lzma),
+    "lz4": (_lz4_compress, _lz4_decompress, 0, lz4),
+    "zstd": (_zstd_compress, _zstd_decompress, 3, zstandard),
+    "blosc": (_blosc_compress, lambda data: blosc2.decompress(bytes(data)), 5, blosc2),
+}
+
+_magic = b"GKSWZ"
+_header = struct.Struct("<5sB8sHQI")
+_chunk_header = struct.Struct("<QQ")
+
+default_chunk_size = 4 * 1024 * 1024
+
+# Pytables library for compressed DataFrames in hdf5 files, as similar as possible to the codec
+_pandas_complibs = {"zlib": "zlib", "lzma": "bzip2", "lz4": "blosc:lz4", "zstd": "blosc:zstd", "blosc": "blosc"}
+
+
+def available_codecs():
+    """Names of the codecs for which the required packages are installed.
+    """
+    return [name for name, codec in codecs.items() if codec[3] is not None]
+
+
+def _shuffle(data, typesize):
+    # Group the first bytes of all elements, then all second bytes and so on. The bytes of
+    # floating point numbers with similar values become much more compressible like this.
+    n = len(data) // typesize * typesize
+    array = np.frombuffer(data, dtype=np.uint8)
+    return array[:n].reshape(-1, typesize).T.tobytes() + array[n:].tobytes()
+
+
+def _unshuffle(data, typesize):
+    n = len(data) // typesize * typesize
+    array = np.frombuffer(data, dtype=np.uint8)
+    return array[:n].reshape(typesize, -1).T.tobytes() + array[n:].tobytes()
+
+
+class Compression(object):
+    """Settings to compress the cache files with.
+
+    The data is split in chunks of `chunk_size` bytes, which are compressed in `n_threads`
+    threads (all CPUs by default). With `shuffle=True`, the bytes of floating point arrays
+    are shuffled before the compression. DataFrames in hdf5 files are compressed by pytables
+    with a similar library instead, for example "bzip2" for "lzma", see `to_hdf`.
+    """
+
+    def __init__(self, codec="zlib", level=None, shuffle=True, n_threads=None, chunk_size=default_chunk_size):
+
+        if codec not in codecs:
+            raise ValueError('Unknown compression codec "{0}", should be one of {1}.'.format(codec, list(codecs)))
+        if codecs[codec][3] is None:
+            raise ImportError('The package for the "{0}" compression codec is not installed.'.format(codec))
+
+        self.codec = codec
+        self.level = codecs[codec][2] if level is None else level
+        self.shuffle = shuffle
+        self.n_threads = os.cpu_count() if n_threads is None else n_threads
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return "Compression({0}, level={1})".format(self.codec, self.level)
+
+    def _compress_chunk(self, chunk, typesize):
+        if typesize > 1:
+            chunk = _shuffle(chunk, typesize)
+        return codecs[self.codec][0](chunk, self.level)
+
+    def compress(self, data, typesize=1):
+        """Compress a bytes-like object into a frame, shuffling the bytes of elements with `typesize` bytes.
+        """
+        data = memoryview(data).cast("B")
+        # Chunks which are a multiple of the typesize, such that they can be shuffled independently
+        chunk_size = max(self.chunk_size // typesize, 1) * typesize
+        chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+        if self.n_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(min(self.n_threads, len(chunks))) as pool:
+                compressed = list(pool.map(lambda chunk: self._compress_chunk(chunk, typesize), chunks))
+        else:
+            compressed = [self._compress_chunk(chunk, typesize) for chunk in chunks]
+
+        header = _header.pack(_magic, 1, self.codec.encode("ascii"), typesize, len(data), len(chunks))
+        chunk_headers = [_chunk_header.pack(len(c), len(chunk)) for c, chunk in zip(compressed, chunks)]
+        return b"".join([header] + chunk_headers + compressed)
+
+    def compress_array(self, array):
+        """Compress the buffer of a numpy array, shuffling the bytes if it contains floating point numbers.
+        """
+        array = np.ascontiguousarray(array)
+        typesize = array.dtype.itemsize if self.shuffle and array.dtype.kind in "fc" else 1
+        return self.compress(array, typesize=typesize)
+
+    def awkward_policy(self):
+        """Compression policy for the `awkward.hdf5` persistence of arrays.
+
+        The hdf5 files written like this can only be read with `awkward_whitelist`.
+        """
+        pair = (self.compress_array, awkward_decompress)
+        return {"minsize": 8192, "types": [np.number, np.bool_], "contexts": "*", "pair": pair}
+
+    def to_hdf(self, df, filename, key="data"):
+        """Write a DataFrame compressed by pytables, which can't use the codecs of this module.
+
+        The codec is replaced by the most similar pytables library: "zlib" by "zlib", "lzma"
+        by "bzip2", "lz4" by "blosc:lz4", "zstd" by "blosc:zstd" and "blosc" by "blosc". The
+        level is limited to the range from 1 to 9, and the bytes are not shuffled.
+        """
+        complevel = max(min(self.level, 9), 1)
+        df.to_hdf(filename, key=key, complib=_pandas_complibs[self.codec], complevel=complevel)
+
+    def dump(self, item, filename):
+        """Pickle an object into a compressed file.
+        """
+        with open(filename, "wb") as f:
+            f.write(self.compress(pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+def is_compressed(data):
+    return bytes(data[: len(_magic)]) == _magic
+
+
+def decompress(data, n_threads=None):
+    """Decompress a frame written by `Compression.compress`.
+    """
+    data = memoryview(data).cast("B")
+
+    magic, version, codec, typesize, size, n_chunks = _header.unpack_from(data)
+    if magic != _magic or version != 1:
+        raise ValueError("Data is not a compressed frame.")
+    decompress_chunk = codecs[codec.rstrip(b"\0").decode("ascii")][1]
+
+    chunks = []
+    offset = _header.size + n_chunks * _chunk_header.size
+    start = 0
+    for i in range(n_chunks):
+        compressed_size, chunk_size = _chunk_header.unpack_from(data, _header.size + i * _chunk_header.size)
+        chunks.append((data[offset : offset + compressed_size], start, start + chunk_size))
+        offset += compressed_size
+        start += chunk_size
+
+    out = bytearray(size)
+    out_view = memoryview(out)
+
+    def work(i):
+        compressed, start, stop = chunks[i]
+        chunk = decompress_chunk(compressed)
+        if typesize > 1:
+            chunk = _unshuffle(chunk, typesize)
+        out_view[start:stop] = chunk
+
+    n_threads = os.cpu_count() if n_threads is None else n_threads
+    if n_threads > 1 and n_chunks > 1:
+        with ThreadPoolExecutor(min(n_threads, n_chunks)) as pool:
+            list(pool.map(work, range(n_chunks)))
+    else:
+        for i in range(n_chunks):
+            work(i)
+
+    return out
+
+
+# The decompression function as referenced in the awkward persistence schema
+awkward_decompress = ("geeksw.utils.compression", "decompress")
+
+# Functions which may be called when reading arrays persisted by awkward
+awkward_whitelist = awkward.persist.whitelist + [list(awkward_decompress)]
+
+
+def load(filename):
+    """Load an object written with `Compression.dump`.
+    """
+    with open(filename, "rb") as f:
+        return pickle.loads(decompress(f.read()))
+
+
+def make_compression(compression):
+    """Compression settings from a codec name, None if `compression` is None.
+    """
+    if compression is None or isinstance(compression, Compression):
+        return compression
+    return Compression(codec=compression)
@@ -1,3 +1,4 @@
+import sys
 import numpy as np
 import pandas as pd
 from geeksw.data_formats import Cutflow
@@ -16,3 +17,17 @@ def concatenate(arrays):
         return Cutflow.average(arrays)
     else:
         return arrays[0].concatenate(arrays[1:])
+
+
+def nbytes(item):
+    """Estimate the memory used by the data of an object in bytes.
+    """
+    if isinstance(item, (pd.DataFrame, pd.Series)):
+        return int(np.sum(item.memory_usage()))
+    if hasattr(item, "nbytes"):
+        return int(item.nbytes)
+    if isinstance(item, (list, tuple)):
+        return sum([nbytes(x) for x in item])
+    if isinstance(item, dict):
+        return sum([nbytes(x) for x in item.values()])
+    return sys.getsizeof(item)
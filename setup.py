@@ -24,7 +24,6 @@ setup(
         "iminuit",
         "uproot",
         "uproot-methods",
-        "lockfile",
         "tables",
         "scipy",
         "tqdm",
@@ -4,8 +4,12 @@ import awkward
 import pandas as pd
 import numpy as np
 import shutil
+import os
+import json
 import geeksw.framework as fwk
 from geeksw.data_formats import Cutflow
+from geeksw.framework.stream import StreamList, LazyStreamList
+from geeksw.utils.compression import Compression, available_codecs
 
 
 np.random.seed(42)
@@ -76,7 +80,58 @@ def make_scalar_nocache(token):
     return a[0]
 
 
-def _test_cache(self, producers, test_disabeled=False, data_transf=lambda a: a, a_transf=lambda a: a, cache_time=None):
+@fwk.one_producer("data")
+@fwk.consumes(token="data_token")
+def make_scalar_modified(token):
+    return a[0] + 1.0
+
+
+@fwk.one_producer("result")
+@fwk.consumes(data="data")
+def make_result(data):
+    return data * 2
+
+
+n_result_calls = [0]
+
+
+@fwk.one_producer("counted_result")
+@fwk.consumes(data="data")
+def make_counted_result(data):
+    n_result_calls[0] += 1
+    return data * 2
+
+
+@fwk.one_producer("final")
+@fwk.consumes(result="counted_result")
+def make_final(result):
+    return result + 1
+
+
+@fwk.one_producer("big_data")
+@fwk.consumes(token="data_token")
+def make_big_data_frame(token):
+    return pd.DataFrame(dict(x=np.arange(1000000, dtype=np.float64)))
+
+
+@fwk.one_producer("modified", cache=False)
+@fwk.consumes(data="big_data")
+def modify_in_place(data):
+    data["x"] *= -1
+    data["y"] = 1.0
+    return len(data)
+
+
+def _test_cache(
+    self,
+    producers,
+    test_disabeled=False,
+    data_transf=lambda a: a,
+    a_transf=lambda a: a,
+    cache_time=None,
+    cache_format="hdf5",
+    compression=None,
+):
 
     # Make sure there is no cache so far
     try:
@@ -89,15 +144,15 @@ def _test_cache(self, producers, test_disabeled=False, data_transf=lambda a: a,
 
     a[:] = np.random.normal(size=n)
 
+    cache = fwk.FrameworkCache(cache_dir, format=cache_format, compression=compression)
+
     record = fwk.produce(
-        products=["/data"], producers=producers, n_stream_workers=32, cache_time=cache_time, cache_dir=cache_dir
+        products=["/data"], producers=producers, n_stream_workers=32, cache_time=cache_time, cache_dir=cache
     )
     np.testing.assert_array_almost_equal(data_transf(record["data"]), a_transf(a))
 
     a[:] = np.random.normal(size=n) + 1.0
-    record = fwk.produce(
-        products=["/data"], producers=producers, n_stream_workers=32, cache_time=0.0, cache_dir=cache_dir
-    )
+    record = fwk.produce(products=["/data"], producers=producers, n_stream_workers=32, cache_time=0.0, cache_dir=cache)
 
     shutil.rmtree(cache_dir)
 
@@ -151,6 +206,191 @@ class Test(unittest.TestCase):
         self, [open_data, make_data_frame_stream], data_transf=lambda data: data[0]["x"].values
     )
 
+    # Test the columnar cache format
+    test_framework_cache_columnar_dataframe = lambda self: _test_cache(
+        self, [open_data, make_data_frame], data_transf=lambda data: data["x"].values, cache_format="columnar"
+    )
+    test_framework_cache_columnar_array = lambda self: _test_cache(
+        self, [open_data, make_array], cache_format="columnar"
+    )
+    test_framework_cache_columnar_jagged = lambda self: _test_cache(
+        self, [open_data, make_jagged], data_transf=lambda data: data.flatten(), cache_format="columnar"
+    )
+    test_framework_cache_columnar_cutflow = lambda self: _test_cache(
+        self,
+        [open_data, make_cutflow],
+        data_transf=lambda cf: cf.efficiency,
+        a_transf=lambda a: Cutflow.frommasks([a > -0.1, a > 0.1], ["cut0", "cut1"]).efficiency,
+        cache_format="columnar",
+    )
+    test_framework_cache_columnar_dataframe_stream = lambda self: _test_cache(
+        self, [open_data, make_data_frame_stream], data_transf=lambda data: data[0]["x"].values, cache_format="columnar"
+    )
+
+    # Test compressed cache entries
+    test_framework_cache_compressed_dataframe = lambda self: _test_cache(
+        self, [open_data, make_data_frame], data_transf=lambda data: data["x"].values, compression="zlib"
+    )
+    test_framework_cache_compressed_cutflow = lambda self: _test_cache(
+        self,
+        [open_data, make_cutflow],
+        data_transf=lambda cf: cf.efficiency,
+        a_transf=lambda a: Cutflow.frommasks([a > -0.1, a > 0.1], ["cut0", "cut1"]).efficiency,
+        compression="lzma",
+    )
+    test_framework_cache_compressed_columnar_jagged = lambda self: _test_cache(
+        self,
+        [open_data, make_jagged],
+        data_transf=lambda data: data.flatten(),
+        cache_format="columnar",
+        compression="zlib",
+    )
+
+    def test_framework_cache_compression(self):
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        x = np.linspace(0.0, 1.0, 100000)
+        jagged = awkward.JaggedArray.fromcounts(np.arange(1000) % 7, np.linspace(0.0, 1.0, 2997))
+
+        for codec in available_codecs():
+            # Small chunks, such that they are compressed in several threads
+            compression = Compression(codec, chunk_size=16384)
+            for cache_format in ["hdf5", "columnar"]:
+                cache = fwk.FrameworkCache(cache_dir, format=cache_format, compression=compression)
+                cache["x"] = x
+                cache["jagged"] = jagged
+                cache["df"] = pd.DataFrame(dict(x=x))
+
+                np.testing.assert_array_equal(cache["x"], x)
+                np.testing.assert_array_equal(cache["jagged"].flatten(), jagged.flatten())
+                np.testing.assert_array_equal(cache["df"]["x"].values, x)
+                self.assertLess(cache.nbytes("x"), x.nbytes / 2)
+
+                shutil.rmtree(cache_dir)
+
+    def test_framework_cache_stream_manifest(self):
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        lengths = [3, 5, 0, 7]
+        stream = StreamList([pd.DataFrame(dict(x=np.arange(k, dtype=np.float64))) for k in lengths])
+
+        for cache_format in ["hdf5", "columnar"]:
+            cache = fwk.FrameworkCache(cache_dir, format=cache_format)
+            cache["stream"] = stream
+
+            manifest = cache.stream_manifest("stream")
+            self.assertEqual([chunk["length"] for chunk in manifest["chunks"]], lengths)
+            self.assertEqual([chunk["start"] for chunk in manifest["chunks"]], [0, 3, 8, 8])
+            self.assertEqual(manifest["schema"]["columns"], ["x"])
+
+            loaded = cache["stream"]
+            self.assertTrue(isinstance(loaded, StreamList))
+            self.assertEqual([len(df) for df in loaded], lengths)
+
+            # resume the stream from the third chunk
+            self.assertEqual([len(df) for df in cache.get_stream("stream", start=2)], lengths[2:])
+
+            lazy = cache.get_stream("stream", stop=2, lazy=True)
+            self.assertTrue(isinstance(lazy, LazyStreamList))
+            self.assertEqual([len(df) for df in lazy], lengths[:2])
+
+            # cache entries without manifest can still be read
+            stream_dir = [f for f in os.listdir(cache_dir) if "__StreamList" in f][0]
+            os.remove(os.path.join(cache_dir, stream_dir, "manifest.json"))
+            self.assertEqual([len(df) for df in cache["stream"]], lengths)
+
+            shutil.rmtree(cache_dir)
+
+    def test_framework_cache_invalidation(self):
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        a[:] = np.random.normal(size=n)
+
+        kwargs = dict(products=["/result"], cache_time=0.0, cache_dir=cache_dir)
+
+        record = fwk.produce(producers=[open_data, make_scalar, make_result], **kwargs)
+        self.assertEqual(record["result"], 2 * a[0])
+
+        # Unchanged producers: the result comes from the cache
+        a[:] = np.random.normal(size=n)
+        record = fwk.produce(producers=[open_data, make_scalar, make_result], **kwargs)
+        self.assertNotEqual(record["result"], 2 * a[0])
+
+        # A modified upstream producer invalidates the cached downstream product
+        record = fwk.produce(producers=[open_data, make_scalar_modified, make_result], **kwargs)
+        self.assertEqual(record["result"], 2 * (a[0] + 1.0))
+
+        shutil.rmtree(cache_dir)
+
+    def test_framework_cache_writer(self):
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        cache = fwk.FrameworkCache(cache_dir)
+        save_times = []
+
+        with fwk.CacheWriter(cache, maxsize=1) as writer:
+            for i in range(3):
+                writer.put(("data" + str(i), "0" * 32), a * i, metadata=dict(runtime=1.0), callback=save_times.append)
+
+        self.assertEqual(len(save_times), 3)
+        for i in range(3):
+            np.testing.assert_array_almost_equal(cache["data" + str(i), "0" * 32], a * i)
+            self.assertEqual(cache.get_metadata(("data" + str(i), "0" * 32))["runtime"], 1.0)
+
+        # no leftovers from the atomic writes
+        self.assertEqual([f for f in os.listdir(cache_dir) if f.startswith(".tmp")], [])
+
+        shutil.rmtree(cache_dir)
+
+    def test_framework_cache_modified_input(self):
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        producers = [open_data, make_big_data_frame, modify_in_place]
+        fwk.produce(products=["/modified"], producers=producers, cache_dir=cache_dir, cache_time=-1.0)
+
+        # the consumer modified its input only after it was written to the cache
+        record = fwk.produce(products=["/big_data"], producers=producers, cache_dir=cache_dir)
+        self.assertEqual(list(record["big_data"].columns), ["x"])
+        np.testing.assert_array_equal(record["big_data"]["x"].values, np.arange(1000000))
+
+        shutil.rmtree(cache_dir)
+
+    def test_framework_cache_planning(self):
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        producers = [open_data, make_scalar, make_counted_result, make_final]
+        kwargs = dict(products=["/final"], producers=producers, cache_time=0.0, cache_dir=cache_dir)
+
+        n_result_calls[0] = 0
+        record = fwk.produce(**kwargs)
+        self.assertEqual(n_result_calls[0], 1)
+
+        # Everything is cached, so the final product is just loaded
+        record = fwk.produce(**kwargs)
+        self.assertEqual(n_result_calls[0], 1)
+
+        # Pretend that loading the cached final and intermediate products is very slow,
+        # so the planner should rather produce them again from the cached data
+        for f in os.listdir(os.path.join(cache_dir, ".meta")):
+            if f.startswith("final") or f.startswith("counted_result"):
+                with open(os.path.join(cache_dir, ".meta", f), "r") as meta_file:
+                    metadata = json.load(meta_file)
+                metadata["load_time"] = 1000.0
+                with open(os.path.join(cache_dir, ".meta", f), "w") as meta_file:
+                    json.dump(metadata, meta_file)
+
+        record_recomputed = fwk.produce(**kwargs)
+        self.assertEqual(n_result_calls[0], 2)
+        self.assertEqual(record_recomputed["final"], record["final"])
+
+        shutil.rmtree(cache_dir)
+
 
 if __name__ == "__main__":
 
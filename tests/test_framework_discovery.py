@@ -0,0 +1,142 @@
+import unittest
+import shutil
+import os
+import sys
+import tempfile
+
+import geeksw.framework as fwk
+from geeksw.framework.discovery import LazyProducer
+from geeksw.framework.ProducerWrapper import ProducerWrapper
+
+cache_dir = ".test_framework_cache"
+
+header = """import os
+import geeksw.framework as fwk
+
+# mark that this module was imported
+open(os.path.join(os.path.dirname(__file__), "imported_" + os.path.basename(__file__)), "w").close()
+"""
+
+sources = {
+    "numbers.py": header
+    + """
+
+@fwk.one_producer("x", cache=False)
+def make_x():
+    return 2
+
+
+@fwk.one_producer("y")
+@fwk.consumes(x="x")
+def make_y(x):
+    return x + 1
+""",
+    "unused.py": header
+    + """
+
+@fwk.stream_producer("z", False)
+@fwk.consumes(y="y")
+def make_z(y):
+    return y * 2
+    # a comment at the end of the function is part of its source
+""",
+    "dynamic.py": header
+    + """
+from geeksw.framework.reduction import add
+
+
+@fwk.one_producer("total", cache=False, reducer=add)
+@fwk.consumes(y="y")
+def make_total(y):
+    return y
+""",
+}
+
+shared_source = """import geeksw.framework as fwk
+
+
+@fwk.one_producer("calib", cache=False)
+def make_calib():
+    return 10
+"""
+
+importing_source = """import geeksw.framework as fwk
+from shared_calibration import make_calib
+
+
+@fwk.one_producer("value", cache=False)
+@fwk.consumes(calib="calib")
+def make_value(calib):
+    return calib + 1
+"""
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.producers_dir = tempfile.mkdtemp()
+        for name, source in sources.items():
+            with open(os.path.join(self.producers_dir, name), "w") as f:
+                f.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.producers_dir, ignore_errors=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def imported(self):
+        return sorted([f[len("imported_") :] for f in os.listdir(self.producers_dir) if f.startswith("imported_")])
+
+    def test_lazy_load_producers(self):
+
+        producers = fwk.load_producers(self.producers_dir)
+
+        # only the module with a reducer, which is not a literal, had to be imported
+        self.assertEqual(self.imported(), ["dynamic.py"])
+        self.assertEqual(sorted([p.product for p in producers]), ["total", "x", "y", "z"])
+
+        make_z = [p for p in producers if p.product == "z"][0]
+        self.assertTrue(isinstance(make_z, LazyProducer))
+        self.assertEqual(make_z.requirements, {"y": "y"})
+        self.assertFalse(make_z.do_cache)
+
+        record = fwk.produce(products=["/y"], producers=producers, cache_dir=cache_dir)
+        self.assertEqual(record["y"], 3)
+        self.assertEqual(self.imported(), ["dynamic.py", "numbers.py"])
+
+    def test_lazy_source_hash(self):
+
+        lazy_producers = fwk.load_producers(self.producers_dir)
+        eager_producers = fwk.load_producers(self.producers_dir, lazy=False)
+
+        self.assertEqual(self.imported(), ["dynamic.py", "numbers.py", "unused.py"])
+
+        def source_hashes(producers):
+            return sorted([ProducerWrapper(p, {}, "", None).source_hash for p in producers])
+
+        # the cache entries stay valid whether the producers are imported or not
+        self.assertEqual(source_hashes(lazy_producers), source_hashes(eager_producers))
+
+    def test_imported_producer(self):
+
+        # a producer defined outside of the producers directory and imported into it
+        shared_dir = tempfile.mkdtemp()
+        with open(os.path.join(shared_dir, "shared_calibration.py"), "w") as f:
+            f.write(shared_source)
+        with open(os.path.join(self.producers_dir, "value.py"), "w") as f:
+            f.write(importing_source)
+
+        sys.path.insert(0, shared_dir)
+        try:
+            producers = fwk.load_producers(self.producers_dir)
+            self.assertIn("calib", [p.product for p in producers])
+
+            record = fwk.produce(products=["/value"], producers=producers, cache_dir=cache_dir)
+            self.assertEqual(record["value"], 11)
+        finally:
+            sys.path.remove(shared_dir)
+            sys.modules.pop("shared_calibration", None)
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
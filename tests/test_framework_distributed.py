@@ -0,0 +1,156 @@
+import unittest
+import shutil
+import pickle
+import tempfile
+import threading
+import time
+import os
+
+import geeksw.framework as fwk
+from geeksw.framework.cache import FrameworkCache
+from geeksw.framework.distributed import LocalJobExecutor, JobError, partition_by_dataset, produce_distributed
+from geeksw.framework.distributed import JobDirectoryExecutor, run_worker
+
+cache_dir = ".test_framework_cache"
+
+
+@fwk.one_producer("pid")
+def get_pid():
+    return os.getpid()
+
+
+@fwk.one_producer("value")
+@fwk.consumes(pid="pid")
+def make_value(pid):
+    return 1
+
+
+@fwk.one_producer("pids")
+@fwk.consumes(pids="*/pid", values="*/value")
+def merge_pids(pids, values):
+    return sorted(pids.values()), sum(values.values())
+
+
+producers = [get_pid, make_value, merge_pids]
+
+
+@fwk.one_producer("calib")
+def make_calib():
+    return 10
+
+
+@fwk.one_producer("<dataset>/calibrated")
+@fwk.consumes(calib="calib", value="value")
+def make_calibrated(calib, value):
+    return calib + value
+
+
+@fwk.one_producer("total")
+@fwk.consumes(calibrated="*/calibrated")
+def make_total(calibrated):
+    return sum(calibrated.values())
+
+
+calib_producers = [get_pid, make_value, make_calib, make_calibrated, make_total]
+
+
+def fail():
+    raise ValueError("this job fails")
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_partition_by_dataset(self):
+
+        partitions = partition_by_dataset(["/pids"], producers, ["/a", "/b"])
+
+        self.assertEqual(sorted(partitions), ["/a", "/b"])
+        for dataset, (partition, outputs) in partitions.items():
+            self.assertEqual(sorted([p.product for p in partition]), [dataset + "/pid", dataset + "/value"])
+            self.assertEqual(sorted(outputs), [dataset + "/pid", dataset + "/value"])
+
+            # the subgraphs are sent to the workers with pickle
+            unpickled = pickle.loads(pickle.dumps(partition))
+            self.assertEqual(set(unpickled), set(partition))
+
+    def test_framework_distributed(self):
+
+        datasets = ["/a", "/b", "/c"]
+
+        executor = LocalJobExecutor(n_workers=2)
+        try:
+            record = produce_distributed(["/pids"], producers, datasets, executor, cache_dir=cache_dir)
+
+            with self.assertRaises(JobError):
+                executor.submit(fail).result()
+        finally:
+            executor.shutdown()
+
+        pids, n_values = record["pids"]
+        self.assertEqual(n_values, 3)
+        # the per-dataset products came from the worker processes
+        self.assertEqual(len(pids), 3)
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_framework_distributed_shared_upstream(self):
+
+        datasets = ["/a", "/b"]
+
+        # the calibration belongs to no dataset, but each dataset needs it
+        partitions = partition_by_dataset(["/total"], calib_producers, datasets)
+        for dataset, (partition, outputs) in partitions.items():
+            self.assertIn("/calib", [p.product for p in partition])
+            self.assertEqual(outputs, [dataset + "/calibrated"])
+
+        executor = LocalJobExecutor(n_workers=2)
+        try:
+            record = produce_distributed(["/total"], calib_producers, datasets, executor, cache_dir=cache_dir)
+        finally:
+            executor.shutdown()
+
+        self.assertEqual(record["total"], 22)
+
+        # only the outputs of the subgraphs were cached by the workers
+        cache = FrameworkCache(cache_dir)
+        self.assertEqual(len(cache.versions("/a/calibrated")), 1)
+        self.assertEqual(cache.versions("/a/value"), [])
+        self.assertEqual(cache.versions("/calib"), [])
+
+    def test_job_directory_executor_failures(self):
+
+        job_dir = tempfile.mkdtemp()
+        executor = JobDirectoryExecutor(job_dir, poll_interval=0.05, heartbeat_timeout=0.5)
+        try:
+            # a worker claims the job and dies before writing the result
+            future = executor.submit(abs, -1)
+            job_file = [f for f in os.listdir(job_dir) if f.endswith(".job")][0]
+            os.rename(os.path.join(job_dir, job_file), os.path.join(job_dir, job_file[: -len(".job")] + ".running"))
+            with self.assertRaises(JobError):
+                future.result(timeout=10)
+
+            # a result which can't be read fails only its own job
+            future = executor.submit(abs, -2)
+            job_file = [f for f in os.listdir(job_dir) if f.endswith(".job")][0]
+            os.remove(os.path.join(job_dir, job_file))
+            with open(os.path.join(job_dir, job_file[: -len(".job")] + ".done"), "wb") as f:
+                f.write(b"not a pickle")
+            with self.assertRaises(pickle.UnpicklingError):
+                future.result(timeout=10)
+
+            # the poller is still alive, and a job running longer than the timeout is fine as long as the worker
+            # is sending heartbeats
+            worker = threading.Thread(target=run_worker, args=(job_dir, 0.05, 2.0, 0.1))
+            worker.start()
+            self.assertEqual(executor.submit(time.sleep, 1.0).result(timeout=10), None)
+            self.assertEqual(executor.submit(abs, -3).result(timeout=10), 3)
+            worker.join()
+        finally:
+            executor.shutdown()
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,78 @@
+import unittest
+import shutil
+import time
+
+import geeksw.framework as fwk
+from geeksw.framework.reduction import add
+
+cache_dir = ".test_framework_cache"
+
+calls = {"value": 0, "total": []}
+
+
+@fwk.one_producer("value")
+def make_value():
+    calls["value"] += 1
+    # slow enough to be loaded from the cache rather than produced again
+    time.sleep(0.05)
+    return 1
+
+
+@fwk.one_producer("total", reducer=add, additive=True)
+@fwk.consumes(values="*/value")
+def make_total(values):
+    calls["total"].append(sorted(values.keys()))
+    time.sleep(0.05)
+    return sum(values.values())
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def run_total(self, datasets, **kwargs):
+        calls["value"] = 0
+        calls["total"] = []
+        record = fwk.produce(
+            products=["/total"],
+            producers=[make_value, make_total],
+            datasets=datasets,
+            cache_dir=cache_dir,
+            cache_time=0.0,
+            **kwargs
+        )
+        return record["total"]
+
+    def test_framework_incremental(self):
+
+        self.assertEqual(self.run_total(["/a", "/b"]), 2)
+        self.assertEqual(calls["value"], 2)
+
+        # only the new dataset is produced and merged
+        self.assertEqual(self.run_total(["/a", "/b", "/c"]), 3)
+        self.assertEqual(calls["value"], 1)
+        self.assertEqual(calls["total"], [["/c"]])
+
+        # nothing to do if the datasets didn't change
+        self.assertEqual(self.run_total(["/a", "/b", "/c"]), 3)
+        self.assertEqual(calls["total"], [])
+
+        # a removed dataset can't be subtracted, so all datasets are merged again
+        self.assertEqual(self.run_total(["/a", "/c"]), 2)
+        self.assertEqual(calls["value"], 0)
+        self.assertEqual(calls["total"], [["/a", "/c"]])
+
+        # without incremental mode, all datasets are merged even if they were merged before
+        self.assertEqual(self.run_total(["/a", "/c", "/d"], incremental=False), 3)
+        self.assertEqual(calls["value"], 1)
+        self.assertEqual(calls["total"], [["/a", "/c", "/d"]])
+
+    def test_additive_without_reducer(self):
+
+        with self.assertRaises(ValueError):
+            fwk.one_producer("total", additive=True)
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,89 @@
+import unittest
+import shutil
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+import geeksw.framework as fwk
+from geeksw.utils.columnar import LazyColumns
+
+cache_dir = ".test_framework_cache"
+
+n = 1000
+columns = ["x" + str(i) for i in range(20)]
+
+
+@fwk.one_producer("table")
+def make_table():
+    # slow enough to be loaded from the cache rather than produced again
+    time.sleep(0.1)
+    return pd.DataFrame({c: np.arange(n) * i for i, c in enumerate(columns)})
+
+
+@fwk.one_producer("sum")
+@fwk.consumes(table="table")
+def make_sum(table):
+    return np.sum(table["x1"] + table.x2)
+
+
+@fwk.one_producer("mean")
+@fwk.consumes(table="table")
+def make_mean(table):
+    return table[["x3"]].mean()["x3"]
+
+
+producers = [make_table, make_sum, make_mean]
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_lazy_columns(self):
+
+        df = make_table()
+
+        cache = fwk.FrameworkCache(cache_dir, format="columnar", lazy=True)
+        cache["table"] = df
+
+        lazy_df = cache["table"]
+        self.assertTrue(isinstance(lazy_df, LazyColumns))
+        self.assertEqual(len(lazy_df), n)
+        self.assertEqual(list(lazy_df.columns), columns)
+
+        np.testing.assert_array_equal(lazy_df["x5"].values, df["x5"].values)
+        self.assertEqual(lazy_df.accessed_columns, set(["x5"]))
+
+        # methods of the DataFrame load everything
+        self.assertEqual(lazy_df.shape, df.shape)
+        self.assertEqual(lazy_df.accessed_columns, set(columns))
+
+    def test_framework_column_usage(self):
+
+        cache = fwk.FrameworkCache(cache_dir, format="columnar", lazy=True)
+
+        kwargs = dict(products=["/sum", "/mean"], producers=producers, cache_dir=cache, cache_time=0.0)
+
+        # run once to cache everything, then only the table is taken from the cache
+        fwk.produce(**kwargs)
+        for f in os.listdir(cache_dir):
+            if f.startswith("sum") or f.startswith("mean"):
+                os.remove(os.path.join(cache_dir, f))
+        record = fwk.produce(**kwargs)
+
+        self.assertEqual(record["sum"], np.sum(np.arange(n) * 3))
+        self.assertEqual(record["mean"], np.mean(np.arange(n) * 3))
+
+        meta_files = [f for f in os.listdir(os.path.join(cache_dir, ".meta")) if f.startswith("table")]
+        self.assertEqual(len(meta_files), 1)
+        with open(os.path.join(cache_dir, ".meta", meta_files[0]), "r") as f:
+            column_usage = json.load(f)["column_usage"]
+
+        self.assertEqual(column_usage, {"sum": ["x1", "x2"], "mean": ["x3"]})
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
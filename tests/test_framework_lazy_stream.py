@@ -0,0 +1,82 @@
+import unittest
+import shutil
+import threading
+import numpy as np
+
+import geeksw.framework as fwk
+
+cache_dir = ".test_framework_cache"
+
+n_chunks = 5
+
+calls = []
+
+
+@fwk.one_producer("chunks", stream=True, lazy=True)
+def load_chunks():
+    for i in range(n_chunks):
+        calls.append(("load", i))
+        yield np.arange(10) + 10 * i
+
+
+@fwk.stream_producer("squared")
+@fwk.consumes(chunks="chunks")
+def square(chunks):
+    calls.append(("square", chunks[0] // 10))
+    return chunks ** 2
+
+
+@fwk.stream_producer("negated")
+@fwk.consumes(squared="squared")
+def negate(squared):
+    calls.append(("negate", int(np.sqrt(squared[0])) // 10))
+    return -squared
+
+
+@fwk.one_producer("total")
+@fwk.consumes(negated="negated")
+def total(negated):
+    return np.sum(negated)
+
+
+producers = [load_chunks, square, negate, total]
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_framework_lazy_stream(self):
+
+        del calls[:]
+
+        record = fwk.produce(products=["/total"], producers=producers, cache_dir=cache_dir, cache_time=0.0)
+
+        self.assertEqual(record["total"], -np.sum(np.arange(10 * n_chunks) ** 2))
+
+        # Each chunk went through the whole pipeline before the next one was loaded
+        expected_calls = [(step, i) for i in range(n_chunks) for step in ["load", "square", "negate"]]
+        self.assertEqual(calls, expected_calls)
+
+    def test_framework_lazy_stream_threads(self):
+
+        record = fwk.produce(
+            products=["/negated"], producers=producers, cache_dir=cache_dir, cache_time=0.0, n_stream_workers=3
+        )
+
+        self.assertTrue(isinstance(record["negated"], fwk.LazyStreamList))
+
+        n_threads = threading.active_count()
+
+        chunks = list(record["negated"])
+        self.assertEqual(len(chunks), n_chunks)
+        for i, chunk in enumerate(chunks):
+            np.testing.assert_array_equal(chunk, -((np.arange(10) + 10 * i) ** 2))
+
+        # the workers for iterating over the stream after produce() are not left running
+        self.assertEqual(threading.active_count(), n_threads)
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,64 @@
+import unittest
+
+from geeksw.framework.core import match_product
+from geeksw.framework.matching import ProducerIndex
+
+
+class Producer(object):
+    def __init__(self, product):
+        self.product = product
+
+
+patterns = [
+    "data",
+    "electrons",
+    "selected_electrons",
+    "<dataset>/electrons",
+    "WWZ/electrons",
+    "hist/<variable>",
+    "hist/pt_<variable>",
+    "<dataset>/hist/<variable>",
+    "win/win",
+    "jenkins",
+]
+
+products = [
+    "WWZ/electrons",
+    "ZZZ/electrons",
+    "ZZZ/selected_electrons",
+    "WWZ/hist/pt",
+    "WWZ/hist/pt_lep1",
+    "hist/eta",
+    "data1/win/win",
+    "data",
+    "some/other_data",
+    "jenkins",
+    "nothing/matches/this",
+]
+
+
+def brute_force_resolve(product, producer_funcs):
+    best, best_score = None, 0
+    for func in producer_funcs:
+        group, score = match_product(product, func)
+        if score > best_score:
+            best, best_score = (func, group), score
+    return best
+
+
+class Test(unittest.TestCase):
+    def test_producer_index(self):
+
+        producer_funcs = [Producer(p) for p in patterns]
+        index = ProducerIndex(producer_funcs)
+
+        for product in products:
+            self.assertEqual(index.resolve(product), brute_force_resolve(product, producer_funcs))
+
+        self.assertEqual(index.resolve("ZZZ/electrons")[0].product, "<dataset>/electrons")
+        self.assertIsNone(index.resolve("nothing/matches/this"))
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,97 @@
+import os
+import unittest
+import shutil
+import numpy as np
+import pandas as pd
+
+import geeksw.framework as fwk
+from geeksw.framework.record import Record
+
+cache_dir = ".test_framework_cache"
+
+n = 125000  # one megabyte of float64
+
+
+@fwk.one_producer("x", cache=False)
+def make_x():
+    return np.arange(n, dtype=np.float64)
+
+
+@fwk.one_producer("y", cache=False)
+def make_y():
+    return np.ones(n, dtype=np.float64)
+
+
+@fwk.one_producer("z", cache=False)
+@fwk.consumes(x="x")
+def make_z(x):
+    return x * 2
+
+
+@fwk.one_producer("result", cache=False)
+@fwk.consumes(x="x", y="y", z="z")
+def make_result(x, y, z):
+    return np.sum(x + y + z)
+
+
+producers = [make_x, make_y, make_z, make_result]
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_record_spilling(self):
+
+        record = Record(memory_budget=1.5e6, spill_dir=cache_dir + "/.spill")
+
+        record["x"] = np.arange(n, dtype=np.float64)
+        record["y"] = np.ones(2 * n, dtype=np.float64)
+
+        # the bigger product got spilled
+        self.assertTrue(record.is_spilled("y"))
+        self.assertFalse(record.is_spilled("x"))
+        self.assertLessEqual(record.memory_usage(), 1.5e6)
+
+        # and it is loaded again on access, spilling the other one
+        np.testing.assert_array_equal(record["y"], np.ones(2 * n))
+        self.assertTrue(record.is_spilled("x"))
+
+        record.close()
+        np.testing.assert_array_equal(record["x"], np.arange(n))
+
+    def test_record_spilling_dtypes(self):
+
+        # every product gets spilled right away
+        record = Record(memory_budget=1, spill_dir=cache_dir + "/.spill")
+
+        times = pd.date_range("2020-01-01", periods=n, freq="s", tz="Europe/Zurich")
+        df = pd.DataFrame(dict(t=times, c=pd.Categorical(np.arange(n) % 3), x=np.ones(n)))
+        named = pd.DataFrame(dict(x=np.ones(n)), index=pd.RangeIndex(501, 501 + n, name="event"))
+
+        record["df"] = df
+        record["named"] = named
+        self.assertTrue(record.is_spilled("named"))
+
+        # spilling does not change the dtypes or the index, or the product is kept in memory
+        pd.testing.assert_frame_equal(record["df"], df)
+        pd.testing.assert_frame_equal(record["named"], named)
+
+        record.close()
+
+    def test_framework_memory_budget(self):
+
+        expected = fwk.produce(products=["/result"], producers=producers, cache_dir=cache_dir)
+
+        record = fwk.produce(products=["/result"], producers=producers, cache_dir=cache_dir, memory_budget=1.5e6)
+
+        self.assertEqual(record["result"], expected["result"])
+
+        # the products really got spilled, and the spill directory of the run is cleaned up
+        self.assertGreater(record.n_spilled, 0)
+        self.assertFalse([f for f in os.listdir(cache_dir) if f.startswith(".spill")])
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
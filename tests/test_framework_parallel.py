@@ -0,0 +1,362 @@
+import os
+import unittest
+import time
+import shutil
+import json
+import tempfile
+
+import numpy as np
+import pandas as pd
+import awkward
+
+import geeksw.framework as fwk
+
+cache_dir = ".test_framework_cache"
+
+sleep_time = 0.5
+
+
+@fwk.one_producer("foo", cache=False)
+def foo():
+    time.sleep(sleep_time)
+    return "foo"
+
+
+@fwk.one_producer("bar", cache=False)
+def bar():
+    time.sleep(sleep_time)
+    return "bar"
+
+
+@fwk.one_producer("baz", cache=False)
+@fwk.consumes(foo="foo")
+def baz(foo):
+    time.sleep(sleep_time)
+    return foo + "baz"
+
+
+@fwk.one_producer("result", cache=False)
+@fwk.consumes(foo="foo", bar="bar", baz="baz")
+def result(foo, bar, baz):
+    return "-".join([foo, bar, baz])
+
+
+producers = [foo, bar, baz, result]
+
+
+@fwk.one_producer("chunks", stream=True, cache=False)
+def make_chunks():
+    return [np.arange(200000 * i, 200000 * (i + 1), dtype=np.float64) for i in range(4)]
+
+
+@fwk.stream_producer("doubled", cache=False)
+@fwk.consumes(chunks="chunks")
+def double_chunks(chunks):
+    return 2 * chunks
+
+
+@fwk.stream_producer("jagged", cache=False)
+@fwk.consumes(chunks="chunks")
+def jagged_chunks(chunks):
+    return awkward.JaggedArray.fromcounts(np.ones(len(chunks), dtype=np.int64), chunks)
+
+
+stream_producers = [make_chunks, double_chunks, jagged_chunks]
+
+
+@fwk.stream_producer("failing", cache=False)
+@fwk.consumes(chunks="chunks")
+def fail_on_first_chunk(chunks):
+    if chunks[0] == 0:
+        raise RuntimeError("bad chunk")
+    return 2 * chunks
+
+
+@fwk.one_producer("lazy_chunks", stream=True, lazy=True, cache=False)
+def make_lazy_chunks():
+    for i in range(8):
+        yield np.arange(200000 * i, 200000 * (i + 1), dtype=np.float64)
+
+
+@fwk.stream_producer("lazy_doubled", cache=False)
+@fwk.consumes(chunks="lazy_chunks")
+def double_lazy_chunks(chunks):
+    return 2 * chunks
+
+
+def shared_memory_segments():
+    return set([f for f in os.listdir("/dev/shm") if f.startswith("psm_")])
+
+
+uneven_sizes = [100000, 1000, 1000, 1000]
+piece_lengths = []
+
+
+@fwk.one_producer("uneven", stream=True, cache=False)
+def make_uneven_chunks():
+    return [np.arange(k, dtype=np.float64) for k in uneven_sizes]
+
+
+@fwk.stream_producer("squared", cache=False, splittable=True)
+@fwk.consumes(chunks="uneven")
+def square_chunks(chunks):
+    piece_lengths.append(len(chunks))
+    return chunks * chunks
+
+
+@fwk.stream_producer("squared_even", cache=False, splittable=True)
+@fwk.consumes(chunks="chunks")
+def square_even_chunks(chunks):
+    piece_lengths.append(len(chunks))
+    return chunks * chunks
+
+
+@fwk.one_producer("uneven_frames", stream=True, cache=False)
+def make_uneven_frames():
+    return [pd.DataFrame(dict(x=np.arange(k, dtype=np.float64))) for k in uneven_sizes]
+
+
+@fwk.stream_producer("selected", cache=False, splittable=True)
+@fwk.consumes(df="uneven_frames")
+def select_entries(df):
+    return df[df["x"] % 500 == 1]
+
+
+class Unsliceable(object):
+    """Chunk which knows its length but can't be sliced, like a TTree.
+    """
+
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+
+@fwk.one_producer("unsliceable", stream=True, cache=False)
+def make_unsliceable():
+    return [Unsliceable(k) for k in uneven_sizes]
+
+
+@fwk.stream_producer("lengths", cache=False, splittable=True)
+@fwk.consumes(chunk="unsliceable")
+def chunk_lengths(chunk):
+    return np.array([len(chunk)])
+
+
+producer_file_source = """import numpy as np
+import geeksw.framework as fwk
+
+
+@fwk.one_producer("chunks", stream=True, cache=False)
+def make_chunks():
+    return [np.arange(200000 * i, 200000 * (i + 1), dtype=np.float64) for i in range(4)]
+
+
+@fwk.stream_producer("doubled", cache=False)
+@fwk.consumes(chunks="chunks")
+def double_chunks(chunks):
+    return 2 * chunks
+"""
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_framework_parallel_threads(self):
+
+        datasets = ["/data1", "/data2"]
+        products = ["/*/result"]
+
+        start_time = time.time()
+        record = fwk.produce(
+            products=products, producers=producers, datasets=datasets, cache_dir=cache_dir, n_workers=4
+        )
+        elapsed_time = time.time() - start_time
+
+        for ds in datasets:
+            self.assertEqual(record[ds + "/result"], "foo-bar-foobaz")
+
+        # 6 producers sleep, but the critical path only has 2 of them
+        self.assertLess(elapsed_time, 4 * sleep_time)
+
+    def test_framework_parallel_processes(self):
+
+        datasets = ["/data1", "/data2"]
+        products = ["/*/result"]
+
+        record_serial = fwk.produce(products=products, producers=producers, datasets=datasets, cache_dir=cache_dir)
+        record = fwk.produce(
+            products=products,
+            producers=producers,
+            datasets=datasets,
+            cache_dir=cache_dir,
+            n_workers=4,
+            executor="processes",
+        )
+
+        self.assertEqual(record, record_serial)
+
+    def test_framework_profile(self):
+
+        datasets = ["/data1", "/data2"]
+        products = ["/*/result"]
+
+        record, profile = fwk.produce(
+            products=products, producers=producers, datasets=datasets, cache_dir=cache_dir, n_workers=4, profile=True
+        )
+
+        self.assertEqual(len(profile.entries), 8)
+        entry = profile.get("/data1/baz")
+        self.assertEqual(entry["kind"], "produce")
+        self.assertEqual(entry["cache"], "disabled")
+        self.assertGreaterEqual(entry["wall_time"], sleep_time)
+
+        path, duration = profile.critical_path()
+        self.assertEqual([p.split("/")[-1] for p in path], ["foo", "baz", "result"])
+        self.assertGreaterEqual(duration, 2 * sleep_time)
+
+        trace = json.loads(profile.to_chrome_trace())
+        self.assertEqual(len(trace["traceEvents"]), 8)
+        self.assertEqual(len(json.loads(profile.to_json())), 8)
+
+    def test_framework_stream_processes(self):
+
+        record = fwk.produce(
+            products=["/doubled", "/jagged"],
+            producers=stream_producers,
+            cache_dir=cache_dir,
+            n_stream_workers=4,
+            stream_executor="processes",
+        )
+
+        self.assertEqual(len(record["doubled"]), 4)
+        np.testing.assert_array_equal(record["doubled"].aggregate(), 2 * np.arange(800000))
+        np.testing.assert_array_equal(record["jagged"][1].flatten(), np.arange(200000, 400000))
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "shared memory segments are not files")
+    def test_framework_stream_processes_cleanup(self):
+
+        segments = shared_memory_segments()
+
+        # the outputs of the other chunks are in shared memory when the first chunk fails
+        with self.assertRaises(RuntimeError):
+            fwk.produce(
+                products=["/failing"],
+                producers=[make_chunks, fail_on_first_chunk],
+                cache_dir=cache_dir,
+                n_stream_workers=4,
+                stream_executor="processes",
+            )
+        self.assertEqual(shared_memory_segments() - segments, set())
+
+        # the chunks which are in flight when the consumer of a lazy stream stops early
+        record = fwk.produce(
+            products=["/lazy_doubled"],
+            producers=[make_lazy_chunks, double_lazy_chunks],
+            cache_dir=cache_dir,
+            n_stream_workers=4,
+            stream_executor="processes",
+        )
+        for chunk in record["lazy_doubled"]:
+            np.testing.assert_array_equal(chunk, 2 * np.arange(200000))
+            break
+        self.assertEqual(shared_memory_segments() - segments, set())
+
+    def test_framework_stream_processes_from_files(self):
+
+        # the modules of producers loaded from files can't be imported by the worker processes
+        producers_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(producers_dir, "chunk_producers.py"), "w") as f:
+                f.write(producer_file_source)
+
+            for lazy in [True, False]:
+                record = fwk.produce(
+                    products=["/doubled"],
+                    producers=fwk.load_producers(producers_dir, lazy=lazy),
+                    cache_dir=cache_dir,
+                    n_stream_workers=2,
+                    stream_executor="processes",
+                )
+                np.testing.assert_array_equal(record["doubled"][3], 2 * np.arange(600000, 800000))
+        finally:
+            shutil.rmtree(producers_dir)
+
+    def test_framework_stream_splitting(self):
+
+        del piece_lengths[:]
+
+        record = fwk.produce(
+            products=["/squared"],
+            producers=[make_uneven_chunks, square_chunks],
+            cache_dir=cache_dir,
+            n_stream_workers=4,
+        )
+
+        self.assertEqual([len(chunk) for chunk in record["squared"]], uneven_sizes)
+        for k, chunk in zip(uneven_sizes, record["squared"]):
+            np.testing.assert_array_equal(chunk, np.arange(k) * np.arange(k))
+
+        # only the big chunk was split, in pieces of the average chunk size
+        self.assertEqual(len(piece_lengths), 7)
+        self.assertEqual(piece_lengths.count(1000), 3)
+        self.assertLessEqual(max(piece_lengths), -(-sum(uneven_sizes) // len(uneven_sizes)))
+
+        # chunks of similar size are not split, even if there are less chunks than workers
+        del piece_lengths[:]
+        fwk.produce(
+            products=["/squared_even"],
+            producers=[make_chunks, square_even_chunks],
+            cache_dir=cache_dir,
+            n_stream_workers=8,
+        )
+        self.assertEqual(piece_lengths, [200000] * 4)
+
+    def test_framework_stream_splitting_inputs(self):
+
+        producers = [make_uneven_frames, select_entries, make_unsliceable, chunk_lengths]
+
+        record = fwk.produce(
+            products=["/selected", "/lengths"], producers=producers, cache_dir=cache_dir, n_stream_workers=4
+        )
+
+        # the index of the selected entries is kept when the pieces are joined
+        self.assertEqual(list(record["selected"][0].index[:3]), [1, 501, 1001])
+        self.assertEqual(list(record["selected"][0].index[-2:]), [99001, 99501])
+
+        # chunks which can't be sliced are processed as a whole
+        self.assertEqual([chunk[0] for chunk in record["lengths"]], uneven_sizes)
+
+    def test_framework_worker_pool(self):
+
+        datasets = ["/data1", "/data2"]
+
+        with fwk.WorkerPool("processes", n_workers=2) as stream_pool, fwk.WorkerPool("threads", 4) as pool:
+
+            for i in range(2):
+                record = fwk.produce(
+                    products=["/doubled"], producers=stream_producers, cache_dir=cache_dir, stream_executor=stream_pool
+                )
+                np.testing.assert_array_equal(record["doubled"].aggregate(), 2 * np.arange(800000))
+
+                start_time = time.time()
+                record = fwk.produce(
+                    products=["/*/result"], producers=producers, datasets=datasets, cache_dir=cache_dir, executor=pool
+                )
+                self.assertLess(time.time() - start_time, 4 * sleep_time)
+                self.assertEqual(record["/data2/result"], "foo-bar-foobaz")
+
+                # the workers stay alive between the calls
+                if i == 0:
+                    workers = (stream_pool._executor, pool._executor)
+                self.assertIs(stream_pool._executor, workers[0])
+                self.assertIs(pool._executor, workers[1])
+
+        self.assertIsNone(pool._executor)
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,80 @@
+import unittest
+import shutil
+import time
+import numpy as np
+
+import geeksw.framework as fwk
+
+cache_dir = ".test_framework_cache"
+
+n = 125000  # one megabyte of float64
+
+
+@fwk.one_producer("x", cache=False)
+def make_x():
+    time.sleep(0.2)
+    return np.arange(n, dtype=np.float64)
+
+
+@fwk.one_producer("y", cache=False)
+def make_y():
+    return np.ones(n, dtype=np.float64)
+
+
+@fwk.one_producer("z")
+@fwk.consumes(x="x")
+def make_z(x):
+    time.sleep(0.1)
+    return x * 2
+
+
+@fwk.one_producer("result", cache=False)
+@fwk.consumes(y="y", z="z")
+def make_result(y, z):
+    return np.sum(y + z)
+
+
+producers = [make_x, make_y, make_z, make_result]
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_framework_plan(self):
+
+        kwargs = dict(products=["/result"], producers=producers, cache_dir=cache_dir)
+
+        # nothing is known before the first run
+        plan = fwk.plan(**kwargs)
+        self.assertEqual(sorted(plan.dag), ["result", "x", "y", "z"])
+        self.assertEqual(plan.dag["result"], ["y", "z"])
+        self.assertEqual(plan.cached_products, [])
+        self.assertEqual(plan.unknown, ["result", "x", "y", "z"])
+
+        fwk.produce(cache_time=10.0, profile=True, **kwargs)
+
+        plan = fwk.plan(**kwargs)
+        self.assertEqual(plan.unknown, [])
+        self.assertGreaterEqual(plan.estimates["x"]["runtime"], 0.2)
+        self.assertEqual(plan.estimates["x"]["output_bytes"], 8 * n)
+
+        path, total = plan.critical_path()
+        self.assertEqual(path, ["x", "z", "result"])
+        self.assertGreaterEqual(total, 0.3)
+
+        # x and z are alive together, y is produced after or before them
+        self.assertGreaterEqual(plan.peak_memory(), 2 * 8 * n)
+
+        # once z is cached, x is not needed anymore
+        fwk.produce(cache_time=0.0, **kwargs)
+        plan = fwk.plan(**kwargs)
+        self.assertEqual(plan.cached_products, ["z"])
+        self.assertEqual(sorted(plan.dag), ["result", "y", "z"])
+        self.assertEqual(plan.estimates["z"]["source"], "cache")
+        self.assertIn("Critical path", str(plan))
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,80 @@
+import unittest
+import shutil
+import numpy as np
+
+import geeksw.framework as fwk
+from geeksw.framework.reduction import tree_reduce, add, merge_cutflows
+from geeksw.data_formats import Cutflow
+
+cache_dir = ".test_framework_cache"
+
+np.random.seed(42)
+chunks = [np.random.normal(size=1000) for i in range(7)]
+bins = np.linspace(-3, 3, 13)
+
+
+@fwk.one_producer("values", stream=True, cache=False)
+def load_values():
+    return chunks
+
+
+@fwk.one_producer("lazy_values", stream=True, lazy=True, cache=False)
+def load_lazy_values():
+    for chunk in chunks:
+        yield chunk
+
+
+@fwk.one_producer("histogram", cache=False, reducer=add)
+@fwk.consumes(values="values")
+def make_histogram(values):
+    return np.histogram(values, bins=bins)[0]
+
+
+@fwk.one_producer("lazy_histogram", cache=False, reducer=add)
+@fwk.consumes(values="lazy_values")
+def make_lazy_histogram(values):
+    return np.histogram(values, bins=bins)[0]
+
+
+@fwk.one_producer("cutflow", cache=False, reducer=merge_cutflows)
+@fwk.consumes(values="values")
+def make_cutflow(values):
+    return Cutflow.frommasks([values > -0.1, values > 0.1], ["cut0", "cut1"])
+
+
+producers = [load_values, load_lazy_values, make_histogram, make_lazy_histogram, make_cutflow]
+
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_tree_reduce(self):
+
+        items = [str(i) for i in range(11)]
+        self.assertEqual(tree_reduce(lambda a, b: a + b, iter(items)), "".join(items))
+        self.assertEqual(tree_reduce(lambda a, b: a + b, ["x"]), "x")
+
+    def test_framework_reducer(self):
+
+        expected_histogram = np.histogram(np.concatenate(chunks), bins=bins)[0]
+        values = np.concatenate(chunks)
+        expected_efficiency = np.mean(values > 0.1)
+
+        for n_stream_workers in [1, 3]:
+            record = fwk.produce(
+                products=["/histogram", "/lazy_histogram", "/cutflow"],
+                producers=producers,
+                cache_dir=cache_dir,
+                n_stream_workers=n_stream_workers,
+            )
+
+            np.testing.assert_array_equal(record["histogram"], expected_histogram)
+            np.testing.assert_array_equal(record["lazy_histogram"], expected_histogram)
+            self.assertEqual(record["cutflow"].nbegin, len(values))
+            self.assertAlmostEqual(record["cutflow"].efficiency, expected_efficiency)
+
+
+if __name__ == "__main__":
+
+    unittest.main(verbosity=2)
@@ -1,5 +1,34 @@
+import os
+import json
+import time
+import shutil
+import socket
 import unittest
-from geeksw.caching import make_f_hash_cache_tracker
+import tempfile
+import multiprocessing
+import numpy as np
+import awkward
+from geeksw.caching import make_f_hash_cache_tracker, IndexedCache, pickle_save, pickle_load
+
+
+def fill_cache(path, worker):
+    cache = IndexedCache(path, save=pickle_save, load=pickle_load)
+    for i in range(20):
+        cache["item-{0}-{1}".format(worker, i)] = i
+
+
+def slow_compute(path):
+    # counts the calls in a file next to the cache
+    with open(os.path.join(path, "calls"), "a") as f:
+        f.write("x")
+    time.sleep(0.5)
+    return "result"
+
+
+def get_or_compute(path):
+    cache = IndexedCache(path, save=pickle_save, load=pickle_load)
+    item, hit = cache.get_or_compute("key", lambda: slow_compute(path), poll_interval=0.01)
+    assert item == "result"
 
 
 class Test(unittest.TestCase):
@@ -44,6 +73,212 @@ class Test(unittest.TestCase):
 
         Jon().say_hello(add_lastname(name))
 
+    def test_indexed_cache(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = IndexedCache(path, save=pickle_save, load=pickle_load)
+
+            cache["a"] = [1, 2, 3]
+            cache["b"] = "bee"
+
+            self.assertIn("a", cache)
+            self.assertNotIn("c", cache)
+            self.assertEqual(cache["a"], [1, 2, 3])
+            self.assertEqual(len(cache), 2)
+
+            del cache["a"]
+            self.assertNotIn("a", cache)
+            self.assertFalse(os.path.exists(os.path.join(path, "a")))
+            with self.assertRaises(ValueError):
+                cache["a"]
+
+            # concurrent inserts from several processes
+            workers = [multiprocessing.Process(target=fill_cache, args=(path, i)) for i in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            self.assertEqual(len(cache), 81)
+            self.assertEqual(cache["item-3-19"], 19)
+
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexed_cache_compression(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = IndexedCache(path, compression="zlib")
+            self.assertTrue(cache.put("x", np.linspace(0.0, 1.0, 10000)))
+            np.testing.assert_array_equal(cache["x"], np.linspace(0.0, 1.0, 10000))
+
+            # a custom save function would not know what to do with the compression
+            with self.assertRaises(ValueError):
+                IndexedCache(path, save=pickle_save, load=pickle_load, compression="zlib")
+
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexed_cache_json_migration(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            pickle_save(os.path.join(path, "old"), {"x": 1})
+            with open(os.path.join(path, "index.json"), "w") as f:
+                json.dump({"old": "dict"}, f, indent=4)
+
+            cache = IndexedCache(path, save=pickle_save, load=pickle_load)
+
+            self.assertEqual(cache["old"], {"x": 1})
+            self.assertFalse(os.path.exists(os.path.join(path, "index.json")))
+
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexed_cache_eviction(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = IndexedCache(path, save=pickle_save, load=pickle_load, max_bytes=1000000, eviction_policy="cost")
+
+            # the cheap items are evicted first
+            for i in range(3):
+                cache.put("cheap-{0}".format(i), bytes(200000), compute_time=0.1)
+            cache.put("expensive", bytes(200000), compute_time=100.0)
+            self.assertEqual(len(cache), 4)
+
+            cache.put("new", bytes(200000), compute_time=1.0)
+            cache.wait()
+
+            self.assertLessEqual(cache.nbytes(), 1000000)
+            self.assertIn("expensive", cache)
+            self.assertIn("new", cache)
+            self.assertNotIn("cheap-0", cache)
+            self.assertFalse(os.path.exists(os.path.join(path, "cheap-0")))
+
+            # with the lru policy, the item which was accessed recently stays
+            lru_cache = IndexedCache(path, save=pickle_save, load=pickle_load, max_bytes=1000000)
+            lru_cache["new"]
+            lru_cache.evict(max_bytes=250000)
+            self.assertEqual(lru_cache.keys(), ["new"])
+
+            cache.close()
+            lru_cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_tracker_result_modified(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            tracker = make_f_hash_cache_tracker(cache_dir=path)
+
+            @tracker
+            def ones(name):
+                return np.ones(3)
+
+            # modifying a result does not change what the cache returns the next time
+            x = ones("a").product
+            x *= 5
+            np.testing.assert_array_equal(ones("a").product, np.ones(3))
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexed_cache_memory(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = IndexedCache(path, save=pickle_save, load=pickle_load, memory_bytes=200000)
+
+            a = np.arange(10000, dtype=np.float64)
+            cache["a"] = a
+            cache["b"] = np.ones(10000)
+
+            # recently saved items come from memory
+            self.assertIs(cache["a"], a)
+            self.assertEqual(cache.memory_usage(), 160000)
+
+            # the least recently used item is dropped from memory, but is still on disk
+            cache["c"] = np.zeros(10000)
+            self.assertEqual(cache.memory_usage(), 160000)
+            np.testing.assert_array_equal(cache["b"], np.ones(10000))
+
+            # deletions by another cache on the same directory are noticed
+            IndexedCache(path, save=pickle_save, load=pickle_load).__delitem__("b")
+            with self.assertRaises(ValueError):
+                cache["b"]
+            self.assertEqual(cache.memory_usage(), 80000)
+
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexed_cache_get_or_compute(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            # several processes need the same missing item, but only one computes it
+            workers = [multiprocessing.Process(target=get_or_compute, args=(path,)) for i in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+                self.assertEqual(worker.exitcode, 0)
+
+            with open(os.path.join(path, "calls"), "r") as f:
+                self.assertEqual(f.read(), "x")
+
+            cache = IndexedCache(path, save=pickle_save, load=pickle_load)
+            self.assertEqual(cache.get_or_compute("key", lambda: "other"), ("result", True))
+
+            # the marker of a process which does not exist anymore is ignored
+            dead = multiprocessing.Process(target=time.sleep, args=(0,))
+            dead.start()
+            dead.join()
+            with open(os.path.join(path, ".in-progress", "orphan"), "w") as f:
+                f.write(socket.gethostname() + " " + str(dead.pid))
+
+            self.assertEqual(cache.get_or_compute("orphan", lambda: 42, poll_interval=0.01), (42, False))
+            self.assertEqual(os.listdir(os.path.join(path, ".in-progress")), [])
+
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexed_cache_mmap(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = IndexedCache(path, mmap=True)
+
+            cache["array"] = np.arange(1000, dtype=np.float64)
+            cache["jagged"] = awkward.JaggedArray.fromcounts([2, 0, 3], np.arange(5, dtype=np.int32))
+
+            array = cache["array"]
+            self.assertIsInstance(array, np.memmap)
+            np.testing.assert_array_equal(array, np.arange(1000))
+
+            jagged = cache["jagged"]
+            self.assertIsInstance(jagged.content, np.memmap)
+            self.assertEqual(jagged.tolist(), [[0, 1], [], [2, 3, 4]])
+
+            with self.assertRaises(ValueError):
+                IndexedCache(path, save=pickle_save, load=pickle_load, mmap=True)
+
+            # the directories count for the size of the cache and are removed with the entries
+            self.assertGreater(cache.nbytes(), 8000)
+            del cache["array"]
+            self.assertFalse(os.path.exists(os.path.join(path, "array")))
+
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
 
 if __name__ == "__main__":
 